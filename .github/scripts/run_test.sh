@@ -5,7 +5,8 @@
 OS=$(uname -s)
 
 opts=""
-[[ ${OS} != "Linux" ]] && opts+="-X container"
+#  inotify based tests are Linux only as well
+[[ ${OS} != "Linux" ]] && opts+="-X container -X linux"
 
 export USE_VENV=0
 cd ${GITHUB_WORKSPACE}/tests || exit 1
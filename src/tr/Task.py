@@ -1,11 +1,79 @@
 from tr.config import Config
-from tr.logTools import info, warn, raw_msg, logging_enabled_for
+from tr.logTools import info, warn, warn_and_print, raw_msg, logging_enabled_for
 from tr.common import TaskException, StringVarExpander
+from tr.uptodate import Fingerprint
+from tr.containers import ContainerPool
+from tr.trace import span
+from tr.stats import command_probe, stats_enabled, container_cgroup_dir
+from tr.timeouts import (CommandTimer, TIMEOUT_RC, NEW_GROUP_KWARGS, signal_group,
+                         terminal_foreground)
+from tr.spawn import Spawner, Process, command_env
+from tr.shellsession import ShellSession
+from tr.outlog import LogFile, OutputTee, open_logs
+from concurrent.futures import ThreadPoolExecutor
+from typing import Mapping, Callable
 import logging
 import os
+import sys
 import shlex
 import subprocess
 import signal
+import threading
+import secrets
+import itertools
+import functools
+import copy
+import time
+
+
+#  Processes of running commands, of all tasks, so runs can be cancelled (see cancel_commands)
+_running: set[Process] = set()
+_running_lock = threading.Lock()
+_cancelled = threading.Event()
+
+
+def cancel_commands(grace: float, sig: int = signal.SIGTERM) -> None:
+    """Stop all running commands ('sig', then SIGKILL after 'grace' seconds), and fail
+    commands about to start, until reset_cancel() is called."""
+    _cancelled.set()
+    with _running_lock:
+        procs = list(_running)
+    info("Cancelling {} running commands", len(procs))
+    for p in procs:
+        signal_group(p, sig)
+
+    def _kill() -> None:
+        with _running_lock:
+            for p in _running:
+                if p in procs:
+                    signal_group(p, signal.SIGKILL)
+    timer = threading.Timer(grace, _kill)
+    timer.daemon = True
+    timer.start()
+
+
+def reset_cancel() -> None:
+    _cancelled.clear()
+
+
+def _pipe_reader(pipe, out, prefix: bytes, lock: threading.Lock, buf: list | None,
+                 log: LogFile | None) -> None:
+    for line in iter(pipe.readline, b""):
+        if log is not None:
+            try:
+                log.write(line)
+            except (OSError, TaskException) as e:
+                warn_and_print(f"Failed writing output log - {e}")
+                log = None
+        if buf is not None:
+            buf.append(line)
+            continue
+        with lock:
+            out.write(prefix + line)
+            out.flush()
+    pipe.close()
+    if log is not None:
+        log.close()
 
 
 class Task(object):
@@ -18,12 +86,23 @@ class Task(object):
         super().__init__()
         info("Initializing task '{}'", name)
         self.name = name
+        self.full_name = config.names.full_name(name)
         model = config.task_model(name, True)
 
         self.short_desc = model.short_desc
         self.long_desc = model.long_desc
         self.hidden = model.hidden
+        self.depends_on = model.depends_on
         self.stop_on_error = model.stop_on_error
+        self.parallel = model.parallel
+        self.max_jobs = model.max_jobs
+        self.parallel_output = model.parallel_output
+        self.timeout = model.timeout
+        self.command_timeout = model.command_timeout
+        self.timeout_signal = signal.Signals[model.timeout_signal.value]
+        self.timeout_grace = model.timeout_grace
+        self._deadline: float | None = None
+        self._task_timed_out = False
         self.commands = model.commands
         self.cwd = model.cwd
         self.shell = model.shell
@@ -34,6 +113,7 @@ class Task(object):
                 self.shell_path = config.default_shell_path
         else:
             self.shell_path = None
+        self.shell_session = model.shell_session
         self.env_inherit = model.inherit_os_env
         self.env = model.env
         self.abstract = model.abstract
@@ -56,13 +136,79 @@ class Task(object):
         self.c_cwd = model.c_cwd
         self.c_env = model.c_env
         self.c_sudo = model.c_sudo
-        self.vars_map = model.variables
+        self.c_session = model.c_session
+        self.c_session_name: str | None = None
+        self.c_pool = model.c_pool
+        self.c_pool_ttl = model.c_pool_ttl
+        self.c_pool_obj: ContainerPool | None = None
+        self.c_cgroup_dir: str | None = None
+        #  Models are shared, and variables are updated by the command line
+        self.vars_map = dict(model.variables)
+        self.matrix = model.matrix
+        self.matrix_exclude = model.matrix_exclude
+        self.matrix_include = model.matrix_include
+        self.variant_of: str | None = None
+        self.inputs = model.inputs
+        self.outputs = model.outputs
+        self.cache_outputs = model.cache_outputs
+        self.output_cache = config.output_cache() if model.cache_outputs else None
+        self.task_root = config.task_root
+        self.force = bool(config.args and config.args.__contains__("force") and config.args.force)
+        if config.args and config.args.__contains__("output_dir") and config.args.output_dir:
+            self.output_log: str | None = os.path.abspath(config.args.output_dir)
+        else:
+            self.output_log = model.output_log
+        self.output_log_max_mb = model.output_log_max_mb
+        self.output_log_keep = model.output_log_keep
+        self.output_log_gzip = model.output_log_gzip
         self.expander = None
+        #  Built on first use, once the task is expanded
+        self._env: Mapping[str, str] | None = None
+        self._spawner: Spawner | None = None
+
+    def matrix_variants(self) -> list["Task"]:
+        """One (unexpanded) task per matrix variables assignment, named 'task[var=value,...]'"""
+        keys = list(self.matrix.keys())
+        for entry in self.matrix_exclude:
+            for k in entry:
+                if k not in self.matrix:
+                    raise TaskException(f"Unknown matrix variable '{k}' in task '{self.name}' "
+                                        "exclude entry")
+        assignments = []
+        for values in itertools.product(*self.matrix.values()):
+            assignment = dict(zip(keys, values))
+            if any(all(assignment[k] == v for k, v in e.items()) for e in self.matrix_exclude):
+                continue
+            assignments.append(assignment)
+        for entry in self.matrix_include:
+            if entry not in assignments:
+                assignments.append(dict(entry))
+        if not assignments:
+            raise TaskException(f"Matrix of task '{self.name}' has no variants")
+
+        variants = []
+        for assignment in assignments:
+            suffix = "[{}]".format(",".join(f"{k}={v}" for k, v in assignment.items()))
+            variant = copy.copy(self)
+            variant.name = self.name + suffix
+            variant.full_name = self.full_name + suffix
+            variant.vars_map = {**self.vars_map, **assignment}
+            variant.variant_of = self.full_name
+            variant.matrix = {}
+            variant.matrix_exclude = []
+            variant.matrix_include = []
+            variants.append(variant)
+        info("Task '{}' matrix has {} variants", self.name, len(variants))
+        return variants
 
     def expand(self) -> None:
         if self.expander is not None:
             warn("Task '{}' is already expanded", self.name)
             return
+        with span("expand", task=self.full_name):
+            self._expand()
+
+    def _expand(self) -> None:
         self.expander = StringVarExpander(self.vars_map)
         info(f"Expanding task '{self.name}'")
         self.env = {self.expander(k): self.expander(v) for k, v in self.env.items()}
@@ -76,6 +222,11 @@ class Task(object):
             self.c_image = self.expander(self.c_image)
         self.c_env = {self.expander(k): self.expander(v) for k, v in self.c_env.items()}
         self.c_volumes = [self.expander(v) for v in self.c_volumes]
+        self.inputs = [self.expander(i) for i in self.inputs]
+        self.outputs = [self.expander(o) for o in self.outputs]
+        if self.output_log:
+            #  Relative to where the commands run, like inputs and outputs
+            self.output_log = os.path.join(self.cwd or os.getcwd(), self.expander(self.output_log))
 
     def _simple_cmd_arr(self, cmd) -> list:
         info("Preparing simple command")
@@ -86,10 +237,90 @@ class Task(object):
         except ValueError as e:
             raise TaskException(f"Illegal command '{cmd}' for task '{self.name}' - {e}")
 
-    def _container_cmd_arr(self, cmd) -> list[str]:
+    def _container_tool_arr(self) -> list[str]:
+        return ["sudo", self.c_tool] if self.c_sudo else [self.c_tool]
+
+    def _container_session_run_arr(self, name: str) -> list[str]:
+        cmd_array = self._container_tool_arr() + ["run", "-d", "--rm", "--name", name]
+        if self.c_cwd:
+            cmd_array += ["-w", self.c_cwd]
+        for v in self.c_volumes:
+            cmd_array += ["-v", v]
+        for k, v in self.c_env.items():
+            cmd_array += ["-e", f"{k}={v}"]
+        cmd_array += self.c_flags.split()
+        #  Keep the container alive until it's removed, regardless of the image's entrypoint
+        cmd_array += ["--entrypoint", self.c_shell_path, self.c_image, "-c",
+                      "trap 'exit 0' TERM; while :; do sleep 3600 & wait $!; done"]
+        return cmd_array
+
+    def _container_pool(self) -> ContainerPool:
+        key_data = {
+            "tool": self._container_tool_arr(), "image": self.c_image, "cwd": self.c_cwd,
+            "volumes": self.c_volumes, "env": self.c_env, "flags": self.c_flags,
+            "shell_path": self.c_shell_path
+        }
+        return ContainerPool(self._container_tool_arr(), self.c_image, key_data, self.c_pool_ttl)
+
+    def _start_container_session(self) -> None:
+        if self.c_pool:
+            self.c_pool_obj = self._container_pool()
+            self.c_session_name = self.c_pool_obj.acquire(self._container_session_run_arr)
+            return
+        name = f"tr-session-{os.getpid()}-{secrets.token_hex(4)}"
+        cmd_array = self._container_session_run_arr(name)
+        info("Starting container session: {}", cmd_array)
+        try:
+            p = subprocess.run(cmd_array, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               text=True)
+        except OSError as e:
+            raise TaskException(f"Error starting container session - {e}")
+        if p.returncode != 0:
+            raise TaskException(f"Error starting container session - {p.stderr.strip()}")
+        self.c_session_name = name
+
+    def _stop_container_session(self) -> None:
+        name = self.c_session_name
+        if not name:
+            return
+        self.c_session_name = None
+        self.c_cgroup_dir = None
+        if self.c_pool_obj:
+            self.c_pool_obj.release()
+            self.c_pool_obj = None
+            return
+        info("Removing container session '{}'", name)
+        cmd_array = self._container_tool_arr() + ["rm", "-f", name]
+        try:
+            subprocess.run(cmd_array, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except OSError as e:
+            warn("Failed to remove container session - {}", e)
+
+    def _container_session_cmd_arr(self, cmd: str) -> list[str]:
+        cmd_array = self._container_tool_arr() + ["exec"]
+        if self.c_interactive:
+            cmd_array.append("-i")
+        if self.c_tty:
+            cmd_array.append("-t")
+        cmd_array.append(self.c_session_name)  # type: ignore
+        if self.c_shell:
+            cmd_array += [self.c_shell_path, "-c", cmd]
+        else:
+            try:
+                cmd_array += shlex.split(cmd)
+            except ValueError as e:
+                raise TaskException(f"Illegal command '{cmd}' for task '{self.name}' - {e}")
+        info("Command is {}", cmd_array)
+        return cmd_array
+
+    def _container_cmd_arr(self, cmd, name: str | None = None) -> list[str]:
         info("Preparing container command")
-        cmd_array: list[str] = ["sudo", self.c_tool] if self.c_sudo else [self.c_tool]
+        if self.c_session_name and cmd is not None:
+            return self._container_session_cmd_arr(cmd)
+        cmd_array = self._container_tool_arr()
         cmd_array.append("exec" if self.c_exec else "run")
+        if name:
+            cmd_array += ["--name", name]
         if self.c_cwd:
             cmd_array += ["-w", self.c_cwd]
         if self.c_interactive:
@@ -116,33 +347,345 @@ class Task(object):
         info("Command is {}", cmd_array)
         return cmd_array
 
-    def _run_cmd(self, cmd: list[str], cmd_str: str) -> int:
+    def _cmd_arr(self, cmd: str | None) -> tuple[list[str], str | None]:
+        """The command's array, and the container to signal if the command times out"""
+        if not self.c_image:
+            return self._simple_cmd_arr(cmd), None
+        if self.c_exec or self.c_session_name or not (self.timeout or self.command_timeout):
+            #  Containers that aren't the command's own are left alone. Session containers are
+            #  removed when the task is done
+            return self._container_cmd_arr(cmd), None
+        name = f"tr-{os.getpid()}-{secrets.token_hex(4)}"
+        return self._container_cmd_arr(cmd, name), name
+
+    def _cmd_env(self) -> Mapping[str, str]:
+        if self._env is None:
+            self._env = command_env(self.env_inherit, self.env)
+        return self._env
+
+    def _get_spawner(self) -> Spawner:
+        if self._spawner is None:
+            self._spawner = Spawner(self._cmd_env(), self.cwd)
+        return self._spawner
+
+    def _popen(self, cmd: list[str], cmd_str: str, pipes: bool = False,
+               null_stdin: bool = False) -> Process:
         info("Running command (joined):")
         raw_msg(cmd_str)
-        p = None
-        if self.env_inherit:
-            env = os.environ
-            env.update(self.env)
-        else:
-            env = self.env
+        if _cancelled.is_set():
+            raise TaskException("Run cancelled")
+        spawner = self._get_spawner()
         try:
-            p = subprocess.Popen(cmd, shell=self.shell,
-                                 executable=self.shell_path, env=env, cwd=self.cwd)
-            return p.wait()
-
+            if spawner.enabled:
+                p: Process = spawner.spawn(cmd, self.shell, self.shell_path, pipes,
+                                           null_stdin=null_stdin)
+            else:
+                pipe = subprocess.PIPE if pipes else None
+                p = subprocess.Popen(cmd, shell=self.shell, executable=self.shell_path,
+                                     env=spawner.env, cwd=self.cwd,
+                                     stdin=subprocess.DEVNULL if null_stdin else None,
+                                     stdout=pipe, stderr=pipe, **NEW_GROUP_KWARGS)
         except (OSError, FileNotFoundError) as e:
             raise TaskException(f"Error occurred running command '{cmd_str}' - {e}")
+        with _running_lock:
+            _running.add(p)
+        if _cancelled.is_set():
+            signal_group(p, signal.SIGTERM)
+        return p
+
+    @staticmethod
+    def _reaped(p: Process) -> None:
+        with _running_lock:
+            _running.discard(p)
+
+    def _cmd_timeout(self) -> tuple[float | None, bool]:
+        """Timeout of a command about to start, and if it's the task's (remaining) timeout"""
+        if self._deadline is None:
+            return self.command_timeout, False
+        remaining = max(self._deadline - time.monotonic(), 0.0)
+        if self.command_timeout is not None and self.command_timeout <= remaining:
+            return self.command_timeout, False
+        return remaining, True
+
+    def _signal_container(self, name: str, sig: int) -> None:
+        cmd_array = self._container_tool_arr() + ["kill", "--signal", signal.Signals(sig).name,
+                                                  name]
+        info("Signaling container: {}", cmd_array)
+        try:
+            subprocess.run(cmd_array, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except OSError as e:
+            warn("Failed to signal container '{}' - {}", name, e)
+
+    def _cmd_timer(self, p: Process, timeout: float | None,
+                   c_name: str | None) -> CommandTimer | None:
+        if timeout is None:
+            return None
+        on_signal = functools.partial(self._signal_container, c_name) if c_name else None
+        return CommandTimer(p, timeout, self.timeout_signal, self.timeout_grace, on_signal)
+
+    def _report_timeout(self, cmd_str: str, task_timeout: bool, timer: CommandTimer | None) -> None:
+        if task_timeout:
+            if self._task_timed_out:
+                return
+            self._task_timed_out = True
+            msg = f"Task '{self.name}' timed out after {self.timeout:g}s"
+        else:
+            msg = f"Command '{cmd_str}' timed out after {timer.seconds:g}s"  # type: ignore
+        if timer and timer.killed:
+            msg += f", killed after {self.timeout_grace:g}s more"
+        warn_and_print(msg)
+
+    def _output_logs(self, index: int | str) -> tuple[LogFile, LogFile] | None:
+        """Output logs of a command, if the task's output is logged"""
+        if not self.output_log:
+            return None
+        name = "{}.{}".format(self.full_name.replace(os.sep, "_"), index)
+        info("Logging command output to '{}/{}.*'", self.output_log, name)
+        return open_logs(self.output_log, name, self.output_log_max_mb * 1024 * 1024,
+                         self.output_log_keep, self.output_log_gzip)
+
+    def _popen_logged(self, cmd: list[str], cmd_str: str,
+                      logs: tuple[LogFile, LogFile] | None) -> tuple[Process, OutputTee | None]:
+        if logs is None:
+            return self._popen(cmd, cmd_str), None
+        #  Command output is written to TR's descriptors directly from now on
+        sys.stdout.flush()
+        sys.stderr.flush()
+        try:
+            p = self._popen(cmd, cmd_str, pipes=True)
+        except BaseException:
+            for log in logs:
+                log.close()
+            raise
+        return p, OutputTee(p.stdout, p.stderr, logs)
+
+    def _run_cmd(self, cmd: list[str], cmd_str: str, c_name: str | None = None,
+                 index: int = 0) -> int:
+        timeout, task_timeout = self._cmd_timeout()
+        if task_timeout and timeout == 0:
+            self._report_timeout(cmd_str, True, None)
+            return TIMEOUT_RC
+        p = None
+        timer = None
+        tee = None
+        try:
+            with span("command", cmd=cmd_str) as s:
+                probe = command_probe(self.full_name, cmd_str, self.c_cgroup_dir)
+                p, tee = self._popen_logged(cmd, cmd_str, self._output_logs(index))
+                timer = self._cmd_timer(p, timeout, c_name)
+                with terminal_foreground(p) as has_terminal:
+                    rc = probe.wait(p) if probe else p.wait()
+                self._reaped(p)
+                if timer:
+                    rc = timer.finish(rc)
+                    if timer.expired:
+                        self._report_timeout(cmd_str, task_timeout, timer)
+                if tee:
+                    #  After the timer is done, leftover processes might hold the pipes open
+                    tee.join()
+                s.set(pid=p.pid, rc=rc)
         except KeyboardInterrupt:
+            if timer:
+                timer.finish(0)
             if p:
-                p.send_signal(signal.SIGINT)
+                signal_group(p, signal.SIGINT)
                 p.wait()
+                self._reaped(p)
+            if tee:
+                tee.join()
+            raise TaskException("User interrupt")
+        if has_terminal and rc == -signal.SIGINT:
+            #  The command has the terminal, so it gets Ctrl-C rather than TR
             raise TaskException("User interrupt")
+        return rc
+
+    def _run_parallel(self, cmds: list[tuple[list[str], str, str | None]]) -> int:
+        max_jobs = self.max_jobs if self.max_jobs else (os.cpu_count() or 1)
+        max_jobs = min(max_jobs, len(cmds))
+        info("Running {} commands in parallel, max_jobs={}", len(cmds), max_jobs)
+        group = self.parallel_output == "group"
+        lock = threading.Lock()
+        cancelled = threading.Event()
+        running: dict[int, Process] = {}
+        rcs: list[int | None] = [None] * len(cmds)
+        failures: list[int] = []
+        label_len = len(str(len(cmds) - 1))
+
+        def _cancel(sig: int) -> None:
+            #  Called with the lock held. Commands aren't polled, as it would reap them before
+            #  their stats probes do.
+            cancelled.set()
+            for p in running.values():
+                signal_group(p, sig)
+
+        def _run(i: int) -> None:
+            with span("command", cmd=cmds[i][1], index=i) as s:
+                _run_one(i, s)
+
+        def _run_one(i: int, s) -> None:
+            cmd_arr, cmd_str, c_name = cmds[i]
+            with lock:
+                if cancelled.is_set():
+                    info("Command {} was cancelled before it started", i)
+                    return
+                timeout, task_timeout = self._cmd_timeout()
+                if task_timeout and timeout == 0:
+                    self._report_timeout(cmd_str, True, None)
+                    rcs[i] = TIMEOUT_RC
+                    _cancel(signal.SIGTERM)
+                    return
+                probe = command_probe(self.full_name, cmd_str, self.c_cgroup_dir)
+                logs = self._output_logs(i) or (None, None)
+                try:
+                    #  Commands can't share the terminal, and a background process group
+                    #  reading it would be stopped
+                    p = self._popen(cmd_arr, cmd_str, pipes=True, null_stdin=True)
+                except BaseException:
+                    for log in logs:
+                        if log:
+                            log.close()
+                    raise
+                running[i] = p
+                timer = self._cmd_timer(p, timeout, c_name)
+            prefix = f"[{i:>{label_len}}] ".encode()
+            bufs = ([], []) if group else (None, None)
+            readers = [threading.Thread(target=_pipe_reader,
+                                        args=(pipe, out, prefix, lock, buf, log))
+                       for pipe, out, buf, log in ((p.stdout, sys.stdout.buffer, bufs[0], logs[0]),
+                                                   (p.stderr, sys.stderr.buffer, bufs[1], logs[1]))]
+            for r in readers:
+                r.start()
+            rc = probe.wait(p) if probe else p.wait()
+            self._reaped(p)
+            if timer:
+                #  Before joining the readers, leftover processes might hold the pipes open
+                rc = timer.finish(rc)
+            s.set(pid=p.pid, rc=rc)
+            for r in readers:
+                r.join()
+            with lock:
+                del running[i]
+                rcs[i] = rc
+                if timer and timer.expired:
+                    self._report_timeout(cmd_str, task_timeout, timer)
+                if group:
+                    for out, buf in ((sys.stdout.buffer, bufs[0]), (sys.stderr.buffer, bufs[1])):
+                        out.writelines(prefix + line for line in buf)  # type: ignore
+                        out.flush()
+                if rc == 0 or cancelled.is_set():
+                    return
+                info("Command {} had failed cmd_rc={}", i, rc)
+                failures.append(rc)
+                if self.stop_on_error or self._task_timed_out:
+                    info("Stopping of first error, cancelling running commands")
+                    _cancel(signal.SIGTERM)
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        executor = ThreadPoolExecutor(max_workers=max_jobs)
+        try:
+            futures = [executor.submit(_run, i) for i in range(len(cmds))]
+            for f in futures:
+                try:
+                    f.result()
+                except TaskException:
+                    with lock:
+                        _cancel(signal.SIGTERM)
+                    raise
+        except KeyboardInterrupt:
+            with lock:
+                _cancel(signal.SIGINT)
+            raise TaskException("User interrupt")
+        finally:
+            executor.shutdown(wait=True)
+
+        if self.stop_on_error and failures:
+            return failures[0]
+        for rc in rcs:
+            if rc:
+                return rc
+        return 0
+
+    def run_plan(self) -> dict | None:
+        """The task's commands and process settings, for running them elsewhere (the client).
+
+        Returns None if running the task takes more than spawning its commands one by one."""
+        if self.expander is None:
+            raise TaskException("Task must be expanded before run")  # Should never happen
+        if self.abstract or self.matrix or self.depends_on or self.inputs or not self.commands or \
+                self.timeout or self.command_timeout or self._in_shell_session() or \
+                self.output_log or \
+                (self.parallel and len(self.commands) > 1) or \
+                (self.c_image and (self.c_session or self.c_pool) and not self.c_exec):
+            return None
+        try:
+            commands = [(self._container_cmd_arr(cmd) if self.c_image else
+                         self._simple_cmd_arr(cmd), cmd) for cmd in self.commands]
+        except TaskException:
+            #  Bad commands fail only when reached
+            return None
+        return {"commands": commands, "shell": self.shell, "shell_path": self.shell_path,
+                "cwd": self.cwd, "env": dict(self._cmd_env()),
+                "stop_on_error": self.stop_on_error}
+
+    def _fingerprint(self) -> Fingerprint:
+        settings = {
+            "commands": self.commands, "cwd": self.cwd, "env": self.env, "shell": self.shell,
+            "shell_path": self.shell_path, "c_image": self.c_image, "c_tool": self.c_tool,
+            "c_volumes": self.c_volumes, "c_env": self.c_env, "c_flags": self.c_flags,
+            "c_cwd": self.c_cwd, "c_exec": self.c_exec, "c_sudo": self.c_sudo,
+            "c_shell": self.c_shell, "c_shell_path": self.c_shell_path, "outputs": self.outputs
+        }
+        cwd = os.path.abspath(self.cwd) if self.cwd else os.getcwd()
+        fingerprint = Fingerprint(self.task_root, self.full_name, cwd, self.inputs, self.outputs,
+                                  settings)
+        with span("fingerprint", task=self.full_name):
+            fingerprint.compute()
+        return fingerprint
 
     def run(self) -> int:
         if self.expander is None:
             raise TaskException("Task must be expanded before run")  # Should never happen
         if self.abstract:
             raise TaskException("Can't run abstract tasks")
+        with span("task", task=self.full_name) as s:
+            rc = self._run()
+            s.set(rc=rc)
+        return rc
+
+    def _run(self) -> int:
+        if not self.inputs:
+            return self._run_commands()
+
+        fingerprint = self._fingerprint()
+        if not self.force and fingerprint.up_to_date():
+            info("Task '{}' is up to date, skipping", self.name)
+            print(f"Task '{self.name}' is up to date")
+            return 0
+        if self.output_cache and not self.force and \
+                self.output_cache.restore(fingerprint.digest, fingerprint.cwd) is not None:
+            print(f"Task '{self.name}' outputs restored from cache")
+            fingerprint.save()
+            return 0
+        rc = self._run_commands()
+        if rc != 0:
+            fingerprint.invalidate()
+            return rc
+        fingerprint.save()
+        if self.output_cache:
+            paths, missing = fingerprint.output_paths()
+            if missing:
+                warn("Task '{}' outputs are missing, not caching: {}", self.name, missing)
+            else:
+                try:
+                    self.output_cache.store(fingerprint.digest, fingerprint.cwd, paths)
+                except OSError as e:
+                    warn("Failed to store task '{}' outputs in cache - {}", self.name, e)
+        return rc
+
+    def _run_commands(self) -> int:
+        self._deadline = time.monotonic() + self.timeout if self.timeout else None
+        self._task_timed_out = False
         if logging_enabled_for(logging.INFO):
             if self.cwd:
                 info("Working directory will be set to '{}'", self.cwd)
@@ -156,19 +699,132 @@ class Task(object):
         if len(self.commands) == 0:
             if self.c_image:
                 info("Running container's default command")
-                return self._run_cmd(self._container_cmd_arr(None), "<CONTAINER_DEFAULT>")
+                cmd_arr, c_name = self._cmd_arr(None)
+                return self._run_cmd(cmd_arr, "<CONTAINER_DEFAULT>", c_name)
             print(f"No commands defined for task '{self.name}'. Nothing to do.")
             return 0
 
+        if self.c_image and (self.c_session or self.c_pool) and not self.c_exec:
+            with span("container_session_start", image=self.c_image):
+                self._start_container_session()
+            if stats_enabled():
+                self.c_cgroup_dir = container_cgroup_dir(self._container_tool_arr(),
+                                                         self.c_session_name)  # type: ignore
+            try:
+                return self._run_cmd_list()
+            finally:
+                self._stop_container_session()
+        if self._in_shell_session():
+            return self._run_shell_session()
+        return self._run_cmd_list()
+
+    def _in_shell_session(self) -> bool:
+        return self.shell and self.shell_session and not self.c_image and \
+            not (self.parallel and len(self.commands) > 1)
+
+    def _run_shell_session(self) -> int:
+        if _cancelled.is_set():
+            raise TaskException("Run cancelled")
+        shell_path = self.shell_path or "/bin/sh"
+        info("Starting shell session with '{}'", shell_path)
+        probe = command_probe(self.full_name, f"<{shell_path} session>")
+        #  The session's commands all share its output
+        logs = self._output_logs("session")
+        if logs:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        try:
+            session = ShellSession(self._get_spawner(), shell_path, self.cwd, pipes=bool(logs))
+        except OSError as e:
+            for log in logs or ():
+                log.close()
+            raise TaskException(f"Error starting shell session for task '{self.name}' - {e}")
+        p = session.p
+        tee = OutputTee(p.stdout, p.stderr, logs) if logs else None
+        with _running_lock:
+            _running.add(p)
+        if _cancelled.is_set():
+            signal_group(p, signal.SIGTERM)
+
+        def _wait() -> int:
+            if p.returncode is None:
+                return probe.wait(p) if probe else p.wait()
+            return p.returncode
+
+        rc = 0
+        try:
+            with terminal_foreground(p) as has_terminal:
+                for i, cmd in enumerate(self.commands):
+                    info("Command is '{}'", cmd)
+                    cmd_rc, ended = self._run_session_cmd(session, cmd, _wait, has_terminal)
+                    if cmd_rc != 0:
+                        info("Command had failed cmd_rc={}", cmd_rc)
+                        if self.stop_on_error or self._task_timed_out:
+                            info("Stopping of first error")
+                            return cmd_rc
+                        if rc == 0:
+                            rc = cmd_rc
+                    if ended:
+                        if i < len(self.commands) - 1:
+                            warn_and_print(f"Shell session of task '{self.name}' ended, "
+                                           f"{len(self.commands) - i - 1} command(s) not run")
+                        break
+        except KeyboardInterrupt:
+            signal_group(p, signal.SIGINT)
+            raise TaskException("User interrupt")
+        finally:
+            session.close()
+            _wait()
+            self._reaped(p)
+            if tee:
+                tee.join()
+        return rc
+
+    def _run_session_cmd(self, session: ShellSession, cmd: str, wait: Callable[[], int],
+                         has_terminal: bool) -> tuple[int, bool]:
+        """Run a command in the shell session. Returns its return code, and if the session
+        ended (i.e. the shell exited). 'has_terminal' tells if the shell was handed the terminal."""
+        timeout, task_timeout = self._cmd_timeout()
+        if task_timeout and timeout == 0:
+            self._report_timeout(cmd, True, None)
+            return TIMEOUT_RC, False
+        info("Running command (joined):")
+        raw_msg(cmd)
+        with span("command", cmd=cmd) as s:
+            #  Commands can't be signaled on their own, so a timeout ends the whole session
+            timer = self._cmd_timer(session.p, timeout, None)
+            rc = session.run(cmd)
+            ended = rc is None
+            if rc is None:
+                rc = wait()
+            if timer:
+                rc = timer.finish(rc)
+                if timer.expired:
+                    ended = True
+                    self._report_timeout(cmd, task_timeout, timer)
+            s.set(pid=session.p.pid, rc=rc)
+        if ended and has_terminal and rc == -signal.SIGINT:
+            #  The shell has the terminal, so it gets Ctrl-C rather than TR
+            raise TaskException("User interrupt")
+        return rc, ended
+
+    def _run_cmd_list(self) -> int:
+        if self.parallel and len(self.commands) > 1:
+            cmds = []
+            for cmd in self.commands:
+                cmd_arr, c_name = self._cmd_arr(cmd)
+                cmds.append((cmd_arr, cmd, c_name))
+            return self._run_parallel(cmds)
+
         rc = 0
-        for cmd in self.commands:
+        for i, cmd in enumerate(self.commands):
             info("Command is '{}'", cmd)
-            cmd_arr = self._container_cmd_arr(cmd) if self.c_image else self._simple_cmd_arr(cmd)
-            cmd_rc = self._run_cmd(cmd_arr, cmd)
+            cmd_arr, c_name = self._cmd_arr(cmd)
+            cmd_rc = self._run_cmd(cmd_arr, cmd, c_name, i)
             if cmd_rc == 0:
                 continue
             info("Command had failed cmd_rc={}", cmd_rc)
-            if self.stop_on_error:
+            if self.stop_on_error or self._task_timed_out:
                 info("Stopping of first error")
                 return cmd_rc
             if rc == 0:
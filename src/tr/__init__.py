@@ -1,7 +1,13 @@
-import pkg_resources
+#  The version is looked up lazily, so the thin client (tr.client) stays cheap to import
 
-try:
-    _vnum = pkg_resources.get_distribution('pytaskrunner').version
-    version = f'v{_vnum}'
-except pkg_resources.DistributionNotFound:
-    version = 'v0.0.0'
+
+def __getattr__(name: str) -> str:
+    if name != "version":
+        raise AttributeError(f"module 'tr' has no attribute '{name}'")
+    from importlib.metadata import version as dist_version, PackageNotFoundError
+    global version
+    try:
+        version = f'v{dist_version("pytaskrunner")}'
+    except PackageNotFoundError:
+        version = 'v0.0.0'
+    return version
@@ -1,13 +1,19 @@
-from tr.config import Config
-from tr.common import TASK_YES_TOKEN, TASK_NO_TOKEN, TaskException, DictDumpFmt
-from tr.config import Config, AutoVarsKeys
+#  Only what the arguments parser needs is imported up front, so shell completion (which runs
+#  the parser on every TAB press) doesn't import the configuration code, pydantic and yaml
+from tr.common import (TASK_YES_TOKEN, TASK_NO_TOKEN, TaskException, DictDumpFmt, AutoVarsKeys,
+                       SchemaDumpOpts, CacheActions, ContainersActions, DaemonActions, WatchPolicy,
+                       StringVarExpander, config_const_vars, set_const_vars_map)
 from tr.logTools import init_logging, info, error_and_print
-from tr.actions import (run_task, list_tasks, show_task_info, dump_task, dump_config, dump_schema,
-                        SchemaDumpOpts)
+from tr.trace import init_tracing, finish_tracing, span
+from tr.stats import init_stats, finish_stats
+from tr.cache import load_completion_index
+from tr.discovery import config_paths
+from tr.client import daemon_request, code_stamp
 from tr import version
 import argparse
 import argcomplete
 import sys
+import os
 
 _RUN_CMD = "run"
 _LIST_CMD = "list"
@@ -15,27 +21,49 @@ _INFO_CMD = "info"
 _DUMP_TASK_CMD = "dump"
 _DUMP_CONFIG_CMD = "dump_config"
 _DUMP_SCHEMA_CMD = "dump_schema"
+_CACHE_CMD = "cache"
+_CONTAINERS_CMD = "containers"
+_DAEMON_CMD = "daemon"
+_CHECK_CMD = "check"
+_WATCH_CMD = "watch"
 
 
-def _tasks_complete(**kwargs) -> list[str]:
+def _indexed_tasks() -> dict[str, str] | None:
+    conf_path, dflt_conf_file = config_paths(None, use_cache=True)
+    if not conf_path:
+        return None
+    #  Include paths are expanded with these, to check the include graph is still the same one
+    set_const_vars_map(config_const_vars(conf_path))
+    return load_completion_index(conf_path, StringVarExpander(), dflt_conf_file)
+
+
+def _tasks_complete(**kwargs) -> dict[str, str]:
     try:
         parsed_args: argparse.Namespace = kwargs['parsed_args']
         parser_name = parsed_args.subparsers_name
     except (KeyError, AttributeError):
-        return []
-    if (parser_name == _RUN_CMD or parser_name == _INFO_CMD or parser_name == _DUMP_TASK_CMD) \
-       and parsed_args.task is None:
-        return Config(None).visible_tasks()
-    return []
+        return {}
+    if parser_name in (_RUN_CMD, _WATCH_CMD) or \
+            (parser_name in (_INFO_CMD, _DUMP_TASK_CMD) and parsed_args.task is None):
+        tasks = _indexed_tasks()
+        if tasks is not None:
+            return tasks
+        reply = daemon_request({"op": "complete", "code": code_stamp(), "cwd": os.getcwd(),
+                                "env": dict(os.environ)})
+        if reply and "tasks" in reply:
+            return reply["tasks"]
+        from tr.config import Config
+        return Config(None).completions()
+    return {}
 
 
-def _parse_arguments() -> argparse.Namespace:
+def parse_arguments(argv: list[str]) -> argparse.Namespace:
     try:
-        ex_args_idx = sys.argv.index('--')
-        tr_argv = sys.argv[1:ex_args_idx]
-        cmds_argv = sys.argv[ex_args_idx + 1:]
+        ex_args_idx = argv.index('--')
+        tr_argv = argv[:ex_args_idx]
+        cmds_argv = argv[ex_args_idx + 1:]
     except ValueError:
-        tr_argv = sys.argv[1:]
+        tr_argv = argv
         cmds_argv = []
     yes_no: list[str] = [TASK_YES_TOKEN, TASK_NO_TOKEN]
     parser = argparse.ArgumentParser(prog='task')
@@ -44,26 +72,51 @@ def _parse_arguments() -> argparse.Namespace:
     parser.add_argument('-C', '--conf', metavar='CONF', help='configuration file to use',
                         default=None)
     parser.add_argument('--log_file', metavar='FILE', help='set log file', default='')
+    parser.add_argument('--trace', metavar='FILE', default='',
+                        help='write a Chrome trace-event file of the run phases')
+    parser.add_argument('--stats', metavar='FILE', default='',
+                        help='write resources usage of executed commands to a JSON file')
+    parser.add_argument('--no-cache', action='store_true', default=False,
+                        help="don't use the configuration cache")
     subparsers = parser.add_subparsers(help='commands', dest='subparsers_name')
     subparsers.required = True
 
-    task_target_parser = argparse.ArgumentParser(add_help=False)
+    task_vars_parser = argparse.ArgumentParser(add_help=False)
+    task_vars_parser.add_argument('-V', '--variable', metavar='VAR', default=[], action='append',
+                                  help='set a variable')
+    task_target_parser = argparse.ArgumentParser(add_help=False, parents=[task_vars_parser])
     task_target_parser.add_argument('task', nargs='?', metavar='TASK', default=None,
                                     help='set task')
-    task_target_parser.add_argument('-V', '--variable', metavar='VAR', default=[], action='append',
-                                    help='set a variable')
-    run_parser = subparsers.add_parser(_RUN_CMD, help='execute a task',
-                                       parents=[task_target_parser])
+    #  Shared by 'run' and 'watch'
+    run_parser = argparse.ArgumentParser(add_help=False, parents=[task_vars_parser])
+    run_parser.add_argument('task', nargs='*', metavar='TASK', default=[],
+                            help='set tasks to run')
     run_parser.add_argument('-c', '--command', metavar='CMD', default=None, action='append',
                             help='set command to run')
     run_parser.add_argument('--cwd', metavar='DIR', default=None, help='set working directory')
     run_parser.add_argument('--shell', type=str, choices=yes_no, action='store', default=None,
                             help='set shell usage')
     run_parser.add_argument('--shell-path', metavar='PATH', help='set shell path', default=None)
+    run_parser.add_argument('--shell-session', choices=yes_no, action='store', default=None,
+                            help='run all commands in one shell')
+    run_parser.add_argument('--output-dir', metavar='DIR', default=None,
+                            help='log the output of every command to DIR')
     run_parser.add_argument('--stop-on-error', choices=yes_no, action='store', default=None,
                             help='set stop behavior on command error')
     run_parser.add_argument('--env', metavar='ENV=VAL', default=None, action='append',
                             help='set an environment variable')
+    run_parser.add_argument('--parallel', choices=yes_no, action='store', default=None,
+                            help='set parallel execution of commands')
+    run_parser.add_argument('-j', '--jobs', metavar='N', type=int, default=None,
+                            help='set max number of concurrent jobs')
+    run_parser.add_argument('--timeout', metavar='SECS', type=float, default=None,
+                            help='set task timeout')
+    run_parser.add_argument('--command-timeout', metavar='SECS', type=float, default=None,
+                            help='set timeout of each command')
+    run_parser.add_argument('-k', '--keep-going', action='store_true', default=False,
+                            help="keep running other tasks when a task fails")
+    run_parser.add_argument('-f', '--force', action='store_true', default=False,
+                            help='run tasks even if they are up to date')
     run_parser.add_argument('-s', '--summary', action='store_true', default=False,
                             help='show task summary before run')
 
@@ -84,6 +137,10 @@ def _parse_arguments() -> argparse.Namespace:
                                    help='set container removal after run')
     cont_run_type_grp.add_argument('--c-exec', action='store_true', default=False,
                                    help='run command in existing container')
+    run_parser.add_argument('--c-session', choices=yes_no, action='store', default=None,
+                            help='run all commands in one container')
+    run_parser.add_argument('--c-pool', choices=yes_no, action='store', default=None,
+                            help='run commands in a pooled container kept between runs')
     run_parser.add_argument('--c-flags', metavar='FLAGS', default=None,
                             help='set container flags')
     run_parser.add_argument('--c-shell', type=str, choices=yes_no, action='store', default=None,
@@ -94,6 +151,17 @@ def _parse_arguments() -> argparse.Namespace:
                             help='set container environment variable')
     run_parser.add_argument('--c-cwd', metavar='DIR', default=None,
                             help='set container working directory')
+    subparsers.add_parser(_RUN_CMD, help='execute tasks', parents=[run_parser])
+
+    watch_parser = subparsers.add_parser(_WATCH_CMD, help='execute tasks whenever files change',
+                                         parents=[run_parser])
+    watch_parser.add_argument('--debounce', metavar='MS', type=int, default=200,
+                              help='wait for MS milliseconds without changes before running')
+    watch_parser.add_argument('--policy', choices=[e.value for e in WatchPolicy],
+                              default=WatchPolicy.WAIT,
+                              help='what to do with a running run when files change')
+    watch_parser.add_argument('--ignore', metavar='GLOB', default=[], action='append',
+                              help='ignore changes of matching files')
 
     info_parser = subparsers.add_parser(_INFO_CMD, help='show task info',
                                         parents=[task_target_parser])
@@ -124,6 +192,26 @@ def _parse_arguments() -> argparse.Namespace:
 
     subparsers.add_parser(_DUMP_CONFIG_CMD, help='dump configuration', parents=[dump_common_parser])
 
+    subparsers.add_parser(_CHECK_CMD, help='validate the whole configuration')
+
+    cache_parser = subparsers.add_parser(_CACHE_CMD, help='manage tasks output cache')
+    cache_parser.add_argument('action', choices=[e.value for e in CacheActions],
+                              default=CacheActions.STATS, nargs='?')
+    cache_parser.add_argument('--all', action='store_true', default=False,
+                              help='remove all entries when pruning')
+
+    containers_parser = subparsers.add_parser(_CONTAINERS_CMD, help='manage pool containers')
+    containers_parser.add_argument('action', choices=[e.value for e in ContainersActions],
+                                   default=ContainersActions.LIST, nargs='?')
+    containers_parser.add_argument('names', metavar='NAME', nargs='*', default=[],
+                                   help='pool containers to stop (default: all)')
+
+    daemon_parser = subparsers.add_parser(_DAEMON_CMD, help='manage the tasks daemon')
+    daemon_parser.add_argument('action', choices=[e.value for e in DaemonActions],
+                               default=DaemonActions.STATUS, nargs='?')
+    daemon_parser.add_argument('--foreground', action='store_true', default=False,
+                               help="don't detach when starting the daemon")
+
     # TODO: Not sure what pyright wants with this type ignore
     argcomplete.autocomplete(parser, always_complete_options=False,
                              default_completer=_tasks_complete)  # type: ignore
@@ -135,34 +223,62 @@ def _parse_arguments() -> argparse.Namespace:
     return args
 
 
+def dispatch(args: argparse.Namespace) -> int:
+    from tr.config import Config
+    from tr.actions import (run_task, list_tasks, show_task_info, dump_task, dump_config,
+                            dump_schema, output_cache_action, containers_action, daemon_action,
+                            check_config_action)
+    from tr.watch import watch_tasks
+    from tr.timeouts import terminate_as_interrupt
+
+    if args.subparsers_name == _DUMP_SCHEMA_CMD:
+        dump_schema(args.type, args.sort, args.format)
+        return 0
+    if args.subparsers_name == _CONTAINERS_CMD:
+        containers_action(args.action, args.names)
+        return 0
+    if args.subparsers_name == _DAEMON_CMD:
+        return daemon_action(args.action, args.foreground, args.log_file)
+
+    with span("config"):
+        config = Config(args, collect_errors=args.subparsers_name == _CHECK_CMD)
+    if args.subparsers_name == _RUN_CMD:
+        with terminate_as_interrupt():
+            return run_task(config)
+    elif args.subparsers_name == _LIST_CMD:
+        list_tasks(config)
+    elif args.subparsers_name == _INFO_CMD:
+        show_task_info(config)
+    elif args.subparsers_name == _DUMP_CONFIG_CMD:
+        dump_config(config, args.sort, args.format)
+    elif args.subparsers_name == _DUMP_TASK_CMD:
+        dump_task(config, args.sort, args.format)
+    elif args.subparsers_name == _CACHE_CMD:
+        output_cache_action(config, args.action, args.all)
+    elif args.subparsers_name == _CHECK_CMD:
+        return check_config_action(config)
+    elif args.subparsers_name == _WATCH_CMD:
+        return watch_tasks(config)
+    return 0
+
+
 def main() -> int:
     try:
-        args = _parse_arguments()
+        args = parse_arguments(sys.argv[1:])
         init_logging(args.log_file, args.verbose)
+        init_tracing(args.trace)
+        init_stats(args.stats)
 
         info("args='{}'", sys.argv[1:])
         info("cmd_args={}", args.__getattribute__(AutoVarsKeys.TASK_CLI_ARGS))
 
-        if args.subparsers_name == _DUMP_SCHEMA_CMD:
-            dump_schema(args.type, args.sort, args.format)
-            return 0
-
-        config = Config(args)
-        if args.subparsers_name == _RUN_CMD:
-            return run_task(config)
-        elif args.subparsers_name == _LIST_CMD:
-            list_tasks(config)
-        elif args.subparsers_name == _INFO_CMD:
-            show_task_info(config)
-        elif args.subparsers_name == _DUMP_CONFIG_CMD:
-            dump_config(config, args.sort, args.format)
-        elif args.subparsers_name == _DUMP_TASK_CMD:
-            dump_task(config, args.sort, args.format)
-
+        return dispatch(args)
     except TaskException as e:
         error_and_print(str(e))
         return 255
-    return 0
+    finally:
+        finish_stats()
+        finish_tracing()
 
 
 if __name__ == "__main__":
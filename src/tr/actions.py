@@ -1,17 +1,25 @@
 from tr.Task import Task
+from tr.scheduler import TaskGraph
 from tr.config import Config, ConfigFileModel, TaskModel
-from tr.common import TaskException, TASK_YES_TOKEN, parse_assignment_str, dump_dict
+from tr.common import (TaskException, TASK_YES_TOKEN, parse_assignment_str, dump_dict,
+                       SchemaDumpOpts, CacheActions, ContainersActions, DaemonActions)
+from tr.containers import pool_containers, stop_pool_container
+from tr.daemon import start_daemon, stop_daemon, daemon_status
+from tr.check import check_config
 from tr.logTools import info
 from argparse import Namespace as Args
 from typing import Any
-from enum import Enum
 import textwrap
+import time
 import sys
 
 
 def _active_task_name(config: Config) -> str:
     if config.args and config.args.task:
         task = config.args.task
+        if isinstance(task, list):
+            #  'run' takes several tasks
+            task = task[0]
     else:
         task = config.default_task_name()
     if task is None:
@@ -53,6 +61,14 @@ def _show_task(task: Task, full_details: bool) -> None:
             print_blob("Description:", task.long_desc)
         print_bool("Hidden:", task.hidden)
         print_bool("Abstract:", task.abstract)
+    if task.matrix:
+        print("Matrix:")
+        for k, values in task.matrix.items():
+            print_val(f"     {k}", ", ".join(values))
+        for i, entry in enumerate(task.matrix_exclude):
+            print_val(f"  Exclude [{i}]", ", ".join(f"{k}={v}" for k, v in entry.items()))
+        for i, entry in enumerate(task.matrix_include):
+            print_val(f"  Include [{i}]", ", ".join(f"{k}={v}" for k, v in entry.items()))
     print_bool("Use shell: ", task.shell)
     if task.shell:
         shell_title = "Shell path:"
@@ -60,6 +76,25 @@ def _show_task(task: Task, full_details: bool) -> None:
             print_val(shell_title, "/usr/bin/sh")
         else:
             print_val(shell_title, task.shell_path)
+        if task.shell_session:
+            print_bool("Shell session:", task.shell_session)
+    if task.depends_on:
+        print_val("Depends on:", ", ".join(task.depends_on))
+    if task.timeout:
+        print_val("Timeout:", f"{task.timeout:g}s")
+    if task.command_timeout:
+        print_val("Command timeout:", f"{task.command_timeout:g}s")
+    if task.timeout or task.command_timeout:
+        print_val("Timeout signal:", f"{task.timeout_signal.name}, SIGKILL after "
+                  f"{task.timeout_grace:g}s")
+    if task.output_log:
+        print_val("Output log:", task.output_log)
+        if task.output_log_max_mb:
+            print_val("  Rotation:", f"at {task.output_log_max_mb}MB, "
+                                     f"keeping {task.output_log_keep} old logs")
+        else:
+            print_val("  Rotation:", "never")
+        print_bool("  Compressed:", task.output_log_gzip)
     print_bool("Inherit environment", task.env_inherit)
     count = 0
     if task.env:
@@ -69,6 +104,12 @@ def _show_task(task: Task, full_details: bool) -> None:
             count += 1
     if task.cwd:
         print_blob("Working directory:", _task_str(task.cwd))
+    if task.inputs:
+        print_blob("Inputs:", " ".join(task.inputs))
+    if task.outputs:
+        print_blob("Outputs:", " ".join(task.outputs))
+        if task.cache_outputs:
+            print_bool("Cache outputs:", task.cache_outputs)
 
     if task.c_image:
         print("Container details:")
@@ -78,6 +119,10 @@ def _show_task(task: Task, full_details: bool) -> None:
         else:
             print_val("  Run image:", image)
             print_bool("  Remove:", task.c_rm)
+            if task.c_session:
+                print_bool("  Single session:", task.c_session)
+            if task.c_pool:
+                print_val("  Pooled, idle TTL:", f"{task.c_pool_ttl}s")
         print_bool("  Interactive:", task.c_interactive)
         print_bool("  Allocate tty:", task.c_tty)
         print_bool("  Use shell: ", task.c_shell)
@@ -109,6 +154,10 @@ def _show_task(task: Task, full_details: bool) -> None:
         return
 
     print_bool("Stop on error:", task.stop_on_error)
+    if task.parallel:
+        print_val("Parallel:", f"Yes, output={task.parallel_output.value}")
+        if task.max_jobs:
+            print_val("Max jobs:", task.max_jobs)
     print("Commands:")
     for i, cmd in enumerate(task.commands):
         print_blob(f"     [{i}]", _task_str(cmd))
@@ -174,9 +223,33 @@ def list_tasks(config: Config) -> None:
               flags, _display_token(t.short_desc, _max_desc_print_len)))
 
 
+def check_config_action(config: Config) -> int:
+    errors = check_config(config)
+    for where, e in errors:
+        print(f"{where}: {e}")
+    if errors:
+        print(f"Found {len(errors)} error{'s' if len(errors) > 1 else ''}")
+        return 1
+    print(f"Configuration is valid, {len(config.tasks)} tasks checked")
+    return 0
+
+
 def args_update(task, args: Args) -> None:
     if args.stop_on_error:
         task.stop_on_error = args.stop_on_error
+    if args.parallel:
+        task.parallel = (args.parallel == TASK_YES_TOKEN)
+    if args.jobs is not None:
+        if args.jobs < 1:
+            raise TaskException("Number of jobs must be a positive integer")
+        task.max_jobs = args.jobs
+    for title, value in (("Timeout", args.timeout), ("Command timeout", args.command_timeout)):
+        if value is not None and value <= 0:
+            raise TaskException(f"{title} must be a positive number of seconds")
+    if args.timeout is not None:
+        task.timeout = args.timeout
+    if args.command_timeout is not None:
+        task.command_timeout = args.command_timeout
     if args.command:
         task.commands = args.command
     if args.cwd:
@@ -185,6 +258,8 @@ def args_update(task, args: Args) -> None:
         task.shell = (args.shell == TASK_YES_TOKEN)
     if args.shell_path:
         task.shell_path = args.shell_path
+    if args.shell_session:
+        task.shell_session = (args.shell_session == TASK_YES_TOKEN)
     if args.env:
         task.env = {}
         for e in args.env:
@@ -203,6 +278,10 @@ def args_update(task, args: Args) -> None:
         task.c_flags = args.c_flags
     if args.c_exec:
         task.c_exec = args.c_exec
+    if args.c_session:
+        task.c_session = (args.c_session == TASK_YES_TOKEN)
+    if args.c_pool:
+        task.c_pool = (args.c_pool == TASK_YES_TOKEN)
     if args.c_rm:
         task.c_rm = (args.c_rm == TASK_YES_TOKEN)
     if args.c_tool:
@@ -223,23 +302,70 @@ def args_update(task, args: Args) -> None:
         task.vars_map[key] = val
 
 
+def _print_run_results(results: list[tuple[str, str, float | None]]) -> None:
+    name_len = max(len("Task"), *(len(r[0]) for r in results))
+    print_fmt = f"{{:<{name_len}}}  {{:<12}}  {{}}"
+    print()
+    print(print_fmt.format("Task", "Result", "Duration"))
+    print(print_fmt.format("----", "------", "--------"))
+    for name, result, duration in results:
+        print(print_fmt.format(name, result, "-" if duration is None else f"{duration:.2f}s"))
+
+
+def root_tasks(config: Config) -> tuple[list[Task], bool]:
+    """The (expanded) tasks to run, with matrix tasks as their variants, and if there are any
+    matrix tasks among them"""
+    tasks = []
+    has_matrix = False
+    for task_name in config.args.task or [_active_task_name(config)]:
+        task = Task(task_name, config)
+        args_update(task, config.args)
+        if task.matrix:
+            has_matrix = True
+            variants = task.matrix_variants()
+        else:
+            variants = [task]
+        for task in variants:
+            task.expand()
+            tasks.append(task)
+    return tasks, has_matrix
+
+
 def run_task(config: Config) -> int:
-    task_name = _active_task_name(config)
-    info("Running task '{}'", task_name)
-    task = Task(task_name, config)
+    tasks, has_matrix = root_tasks(config)
+    for task in tasks:
+        info("Running task '{}'", task.name)
+        if config.args.summary:
+            _show_task(task, False)
+            print("-" * 70)
+            sys.stdout.flush()
+    if len(tasks) == 1:
+        if not tasks[0].depends_on:
+            return tasks[0].run()
+        return TaskGraph(config, tasks).run(config.args.jobs, config.args.keep_going)
+
+    #  Like 'task run a && task run b', unless concurrency is explicitly requested. Matrix
+    #  variants run concurrently, up to the jobs limit
+    graph = TaskGraph(config, tasks)
+    rc = graph.run(config.args.jobs or (None if has_matrix else 1), config.args.keep_going)
+    _print_run_results(graph.results())
+    return rc
+
+
+def run_plan(config: Config) -> dict | None:
+    """Like run_task(), but return the task's commands for the caller to run (see Task.run_plan)"""
+    if config.args.task and len(config.args.task) > 1:
+        return None
+    task = Task(_active_task_name(config), config)
+    if task.matrix:
+        return None
     args_update(task, config.args)
     task.expand()
-    if config.args.summary:
+    plan = task.run_plan()
+    if plan is not None and config.args.summary:
         _show_task(task, False)
         print("-" * 70)
-        sys.stdout.flush()
-    return task.run()
-
-
-class SchemaDumpOpts(str, Enum):
-    ALL = "all"
-    CONFIG = "config"
-    TASK = "task"
+    return plan
 
 
 def dump_schema(dump_type: str, sort: bool, fmt: str) -> None:
@@ -258,10 +384,86 @@ def dump_schema(dump_type: str, sort: bool, fmt: str) -> None:
 
 def dump_task(config: Config, sort: bool, fmt: str) -> None:
     task_name = _active_task_name(config)
-    includes = set() if config.args.includes else None
-    desc = config.task_desc(task_name, includes)
+    desc = config.task_desc(task_name, config.args.includes)
     print(dump_dict(desc, sort, fmt))
 
 
+def _size_str(size: int) -> str:
+    if size < 1024:
+        return f"{size}B"
+    value = float(size)
+    for unit in ["KB", "MB", "GB"]:
+        value /= 1024
+        if value < 1024:
+            break
+    return f"{value:.1f}{unit}"
+
+
+def output_cache_action(config: Config, action: str, prune_all: bool) -> None:
+    cache = config.output_cache()
+    if action == CacheActions.PRUNE:
+        if prune_all:
+            entries, size = cache.prune(0, grace=0)
+        else:
+            entries, size = cache.prune(config.conf.output_cache_size_mb * 1024 * 1024)
+        print(f"Removed {entries} entries, {_size_str(size)}")
+        return
+    stats = cache.stats()
+    print(f"{'Location:':<24}{stats['path']}")
+    print(f"{'Entries:':<24}{stats['entries']}")
+    print(f"{'Objects:':<24}{stats['objects']}")
+    print(f"{'Size:':<24}{_size_str(stats['size'])} (max {_size_str(stats['max_size'])})")
+
+
+def _duration_str(secs: float) -> str:
+    secs = int(secs)
+    if secs < 60:
+        return f"{secs}s"
+    if secs < 3600:
+        return f"{secs // 60}m{secs % 60:02}s"
+    return f"{secs // 3600}h{secs // 60 % 60:02}m"
+
+
+def containers_action(action: str, names: list[str]) -> None:
+    containers = pool_containers()
+    if action == ContainersActions.STOP:
+        if not names:
+            names = [c["name"] for c in containers]
+        for name in names:
+            if not stop_pool_container(name):
+                raise TaskException(f"No such pool container '{name}'")
+            print(f"Stopped '{name}'")
+        return
+    if not containers:
+        return
+    now = time.time()
+    print(f"{'Name':<26}{'Image':<30}{'Users':<7}{'Idle':<10}TTL")
+    for c in containers:
+        idle = "-" if c["users"] else _duration_str(now - c["last_used"])
+        print(f"{c['name']:<26}{c['image']:<30}{len(c['users']):<7}{idle:<10}"
+              f"{_duration_str(c['ttl'])}")
+
+
+def daemon_action(action: str, foreground: bool, log_file: str) -> int:
+    if action == DaemonActions.START:
+        start_daemon(foreground, log_file)
+        return 0
+    if action == DaemonActions.STOP:
+        if not stop_daemon():
+            raise TaskException("Daemon isn't running")
+        return 0
+    status = daemon_status()
+    if status is None:
+        print("Daemon isn't running")
+        return 1
+    print(f"{'Pid:':<24}{status['pid']}")
+    print(f"{'Version:':<24}{status['version']}")
+    print(f"{'Uptime:':<24}{_duration_str(status['uptime'])}")
+    print(f"{'Requests served:':<24}{status['served']}")
+    print(f"{'Cached configurations:':<24}{status['configs']}")
+    print(f"{'Watching files:':<24}{'Yes' if status['watched'] else 'No'}")
+    return 0
+
+
 def dump_config(config: Config, sort: bool, fmt: str) -> None:
     print(dump_dict(config.conf.model_dump(), sort, fmt))
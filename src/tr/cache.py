@@ -0,0 +1,206 @@
+from tr.logTools import info, verbose
+from tr.client import code_stamp
+import os
+import pickle
+import hashlib
+import pathlib
+import tempfile
+from typing import Any
+
+#  Bump whenever the layout of cached objects changes
+_CACHE_FORMAT = 4
+_CONFIG_CACHE_SUBDIR = "config"
+_COMPLETION_INDEX_SUBDIR = "complete"
+
+
+def cache_dir() -> str:
+    base = os.getenv("XDG_CACHE_HOME") or os.path.join(str(pathlib.Path.home()), ".cache")
+    return os.path.join(base, "taskrunner")
+
+
+def _path_key(path: str) -> str:
+    return hashlib.sha256(os.path.abspath(path).encode()).hexdigest()
+
+
+def file_stamp(path: str) -> tuple[str, int, int] | None:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return os.path.abspath(path), st.st_size, st.st_mtime_ns
+
+
+def write_atomic(path: str, data: bytes) -> None:
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class ConfigDeps(object):
+    """Everything the merged configuration depends on, besides file contents."""
+
+    def __init__(self) -> None:
+        #  (path, size, mtime) of every file in the include graph
+        self.files: list[tuple[str, int, int]] = []
+        #  (raw, expanded) pair for every include entry
+        self.includes: list[tuple[str, str]] = []
+        self.dflt_conf_file: str | None = None
+
+    def add_file(self, path: str) -> None:
+        stamp = file_stamp(path)
+        if stamp:
+            self.files.append(stamp)
+
+    def add_include(self, raw: str, expanded: str) -> None:
+        self.includes.append((raw, expanded))
+
+
+def _config_cache_path(conf_path: str) -> str:
+    return os.path.join(cache_dir(), _CONFIG_CACHE_SUBDIR, f"{_path_key(conf_path)}.pickle")
+
+
+def _cache_header() -> tuple:
+    #  The cache holds task models, so any code change (not just a new version) invalidates it
+    return (_CACHE_FORMAT, code_stamp())
+
+
+#  Optional in-memory layer, used by long running processes (the daemon):
+#  configuration path -> (deps, payload)
+_memory_cache: dict[str, tuple[ConfigDeps, Any]] | None = None
+#  Set when entries are dropped as soon as any of their files change
+_memory_cache_watched = False
+
+
+def enable_memory_cache(watched: bool) -> None:
+    global _memory_cache
+    global _memory_cache_watched
+    _memory_cache = {}
+    _memory_cache_watched = watched
+
+
+def memory_cache_entries() -> dict[str, tuple[ConfigDeps, Any]]:
+    return _memory_cache if _memory_cache is not None else {}
+
+
+def drop_memory_cache_entries(changed_path: str | None = None) -> None:
+    """Drop entries depending on 'changed_path', or all entries if it's None."""
+    if _memory_cache is None:
+        return
+    for conf_path, (deps, _) in list(_memory_cache.items()):
+        if changed_path is None or any(stamp[0] == changed_path for stamp in deps.files):
+            info("Dropping in-memory configuration cache of '{}'", conf_path)
+            del _memory_cache[conf_path]
+
+
+def _deps_valid(deps: ConfigDeps, expander, dflt_conf_file: str | None, check_files: bool) -> bool:
+    if deps.dflt_conf_file != dflt_conf_file:
+        info("Default configuration file changed")
+        return False
+    if check_files:
+        for stamp in deps.files:
+            if file_stamp(stamp[0]) != stamp:
+                info("Configuration file '{}' changed", stamp[0])
+                return False
+    #  Include paths might refer to variables (e.g. '{{cwd}}', '{{$HOME}}'), so they are
+    #  re-expanded to make sure the include graph is still the same one
+    for raw, expanded in deps.includes:
+        if expander(raw) != expanded:
+            info("Include '{}' expansion changed", raw)
+            return False
+    return True
+
+
+def load_config_cache(conf_path: str, expander,
+                      dflt_conf_file: str | None) -> tuple[ConfigDeps, Any] | None:
+    if _memory_cache is not None:
+        entry = _memory_cache.get(os.path.abspath(conf_path))
+        if entry and _deps_valid(entry[0], expander, dflt_conf_file,
+                                 check_files=not _memory_cache_watched):
+            verbose("Using in-memory configuration cache of '{}'", conf_path)
+            return entry
+
+    path = _config_cache_path(conf_path)
+    try:
+        with open(path, "rb") as f:
+            header, deps, payload = pickle.load(f)
+    except FileNotFoundError:
+        info("No configuration cache for '{}'", conf_path)
+        return None
+    except Exception as e:
+        info("Ignoring unreadable configuration cache '{}' - {}", path, e)
+        return None
+
+    if header != _cache_header():
+        info("Configuration cache format mismatch")
+        return None
+    if not _deps_valid(deps, expander, dflt_conf_file, check_files=True):
+        return None
+    verbose("Using configuration cache '{}'", path)
+    if _memory_cache is not None:
+        _memory_cache[os.path.abspath(conf_path)] = (deps, payload)
+    return deps, payload
+
+
+def save_config_cache(conf_path: str, deps: ConfigDeps, payload: Any) -> None:
+    if _memory_cache is not None:
+        _memory_cache[os.path.abspath(conf_path)] = (deps, payload)
+    path = _config_cache_path(conf_path)
+    try:
+        data = pickle.dumps((_cache_header(), deps, payload), protocol=pickle.HIGHEST_PROTOCOL)
+        write_atomic(path, data)
+        verbose("Configuration cache saved to '{}'", path)
+    except Exception as e:
+        info("Failed to save configuration cache '{}' - {}", path, e)
+
+
+#  The completion index holds just what shell completion needs, so completing task names doesn't
+#  have to load (and import the code of) the configuration cache
+def _completion_index_path(conf_path: str) -> str:
+    return os.path.join(cache_dir(), _COMPLETION_INDEX_SUBDIR, f"{_path_key(conf_path)}.pickle")
+
+
+def has_completion_index(conf_path: str) -> bool:
+    return os.path.exists(_completion_index_path(conf_path))
+
+
+def load_completion_index(conf_path: str, expander,
+                          dflt_conf_file: str | None) -> dict[str, str] | None:
+    """Visible task names and their short descriptions, if the index is up to date"""
+    path = _completion_index_path(conf_path)
+    try:
+        with open(path, "rb") as f:
+            header, deps, tasks = pickle.load(f)
+    except FileNotFoundError:
+        info("No completion index for '{}'", conf_path)
+        return None
+    except Exception as e:
+        info("Ignoring unreadable completion index '{}' - {}", path, e)
+        return None
+
+    if header != _cache_header():
+        info("Completion index format mismatch")
+        return None
+    if not _deps_valid(deps, expander, dflt_conf_file, check_files=True):
+        return None
+    verbose("Using completion index '{}'", path)
+    return tasks
+
+
+def save_completion_index(conf_path: str, deps: ConfigDeps, tasks: dict[str, str]) -> None:
+    path = _completion_index_path(conf_path)
+    try:
+        data = pickle.dumps((_cache_header(), deps, tasks), protocol=pickle.HIGHEST_PROTOCOL)
+        write_atomic(path, data)
+        verbose("Completion index saved to '{}'", path)
+    except Exception as e:
+        info("Failed to save completion index '{}' - {}", path, e)
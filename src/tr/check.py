@@ -0,0 +1,85 @@
+from tr.config import Config, TaskModel
+from tr.common import TaskException, StringVarExpander, AutoVarsKeys, template_vars
+from tr.logTools import info
+
+_AUTO_VARS = {AutoVarsKeys.TASK_ROOT, AutoVarsKeys.CWD, AutoVarsKeys.TASK_CLI_ARGS}
+
+
+def _templates(model: TaskModel) -> list[tuple[str, str]]:
+    """(location, template) of every expanded task setting, see Task.expand()"""
+    templates = [(f"commands/{i}", c) for i, c in enumerate(model.commands)]
+    for title, d in (("env", model.env), ("c_env", model.c_env)):
+        for k, v in d.items():
+            templates += [(f"{title}/{k}", k), (f"{title}/{k}", v)]
+    for title, lst in (("c_volumes", model.c_volumes), ("inputs", model.inputs),
+                       ("outputs", model.outputs)):
+        templates += [(f"{title}/{i}", v) for i, v in enumerate(lst)]
+    for title, v in (("cwd", model.cwd), ("c_cwd", model.c_cwd), ("c_image", model.c_image),
+                     ("output_log", model.output_log)):
+        if v:
+            templates.append((title, v))
+    templates += [(f"variables/{k}", v) for k, v in model.variables.items()]
+    return templates
+
+
+def _check_vars(templates: list[tuple[str, str]], known: set[str],
+                expander: StringVarExpander) -> list[str]:
+    errors = []
+    for loc, template in templates:
+        for var in template_vars(template):
+            if not var.startswith("$") and var not in known:
+                errors.append(f"'{loc}': Unknown variable '{var}'")
+        try:
+            expander(template)
+        except TaskException as e:
+            errors.append(f"'{loc}': {e}")
+    return errors
+
+
+def check_config(config: Config) -> list[tuple[str, str]]:
+    """Validate the whole configuration. Returns (where, error) of all errors found."""
+    errors = [("Include", e) for e in config.include_errors or []]
+    global_known = set(config.conf.variables) | _AUTO_VARS
+    for e in _check_vars([(f"variables/{k}", v) for k, v in config.conf.variables.items()],
+                         global_known, StringVarExpander()):
+        errors.append(("Global variables", e))
+    if config.default_task_name():
+        try:
+            config.names.full_name(config.default_task_name())  # type: ignore
+        except TaskException as e:
+            errors.append(("Default task", str(e)))
+
+    resolver = config.resolver
+    task_errors = resolver.errors()
+    #  Every loop is reported once, rather than by each of its tasks
+    for loop in resolver.loops:
+        errors.append(("Inheritance loop", " -> ".join(f"'{t}'" for t in loop + loop[:1])))
+    in_loops = {t for loop in resolver.loops for t in loop}
+    for name in config.tasks:
+        where = f"Task '{name}'"
+        if name in in_loops:
+            try:
+                resolver.raw_model(name)
+            except TaskException as e:
+                errors.append((where, str(e)))
+            continue
+        if name in task_errors:
+            errors.append((where, task_errors[name]))
+            continue
+        model = config.task_model(name, True)
+        for dep in model.depends_on:
+            try:
+                config.names.full_name(dep)
+            except TaskException as e:
+                errors.append((where, f"'depends_on': {e}"))
+        if model.abstract:
+            #  Variables might be set by derived tasks
+            continue
+        matrix_vars = set(model.matrix)
+        for entry in model.matrix_include:
+            matrix_vars.update(entry)
+        expander = StringVarExpander({**model.variables, **{k: "" for k in matrix_vars}})
+        known = global_known | set(model.variables) | matrix_vars
+        errors += [(where, e) for e in _check_vars(_templates(model), known, expander)]
+    info("Configuration check found {} errors in {} tasks", len(errors), len(config.tasks))
+    return errors
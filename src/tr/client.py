@@ -0,0 +1,112 @@
+"""Thin 'task' entry point.
+
+When a 'task daemon' is running, requests are sent to it over a Unix socket and only the standard
+library is imported here. Otherwise (or when the daemon can't serve a request) the CLI runs in
+process, as usual.
+"""
+import os
+import sys
+import json
+import signal
+import socket
+
+_NO_DAEMON_ENV = "TASK_NO_DAEMON"
+_SOCKET_NAME = "taskrunner-daemon.sock"
+
+
+def socket_path() -> str:
+    base = os.getenv("XDG_RUNTIME_DIR")
+    if not base:
+        cache_base = os.getenv("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+        base = os.path.join(cache_base, "taskrunner")
+    return os.path.join(base, _SOCKET_NAME)
+
+
+def code_stamp() -> str:
+    """Identifies the installed code, so a daemon running older code isn't used."""
+    pkg_dir = os.path.dirname(os.path.abspath(__file__))
+    with os.scandir(pkg_dir) as it:
+        mtime = max(e.stat().st_mtime_ns for e in it if e.name.endswith(".py"))
+    return f"{pkg_dir}:{mtime}"
+
+
+def recv_msg(sock: socket.socket) -> dict:
+    chunks = []
+    while chunk := sock.recv(1 << 16):
+        chunks.append(chunk)
+    return json.loads(b"".join(chunks))
+
+
+def send_msg(sock: socket.socket, msg: dict) -> None:
+    sock.sendall(json.dumps(msg).encode())
+    sock.shutdown(socket.SHUT_WR)
+
+
+def daemon_request(msg: dict, timeout: float | None = None) -> dict | None:
+    """Send a request to the daemon. Returns None if there's no daemon to talk to."""
+    if os.getenv(_NO_DAEMON_ENV):
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(socket_path())
+            send_msg(sock, msg)
+            return recv_msg(sock)
+    except (OSError, ValueError):
+        return None
+
+
+def _run_plan(plan: dict) -> int:
+    import subprocess
+    rc = 0
+    for cmd, cmd_str in plan["commands"]:
+        p = None
+        try:
+            p = subprocess.Popen(cmd, shell=plan["shell"], executable=plan["shell_path"],
+                                 env=plan["env"], cwd=plan["cwd"])
+            cmd_rc = p.wait()
+        except OSError as e:
+            print(f"Error occurred running command '{cmd_str}' - {e}")
+            return 255
+        except KeyboardInterrupt:
+            if p:
+                p.send_signal(signal.SIGINT)
+                p.wait()
+            print("User interrupt")
+            return 255
+        if cmd_rc == 0:
+            continue
+        if plan["stop_on_error"]:
+            return cmd_rc
+        if rc == 0:
+            rc = cmd_rc
+    return rc
+
+
+def _daemon_main() -> int | None:
+    if "_ARGCOMPLETE" in os.environ:
+        return None
+    reply = daemon_request({"op": "cli", "code": code_stamp(), "argv": sys.argv[1:],
+                            "cwd": os.getcwd(), "env": dict(os.environ)})
+    if reply is None or reply.get("fallback"):
+        return None
+    sys.stdout.write(reply.get("stdout", ""))
+    sys.stderr.write(reply.get("stderr", ""))
+    plan = reply.get("plan")
+    if plan is None:
+        return reply["rc"]
+    sys.stdout.flush()
+    sys.stderr.flush()
+    return _run_plan(plan)
+
+
+def main() -> int:
+    rc = _daemon_main()
+    if rc is not None:
+        return rc
+    from tr.__main__ import main as tr_main
+    return tr_main()
+
+
+if __name__ == "__main__":
+    exit(main())
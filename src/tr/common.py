@@ -1,15 +1,18 @@
 from tr.logTools import start_raw_logging, stop_raw_logging, verbose
 import sys
 import re
+import functools
 import os
 import traceback
 import json
-import copy
-import yaml
-from typing import Any
-from pydantic import ValidationError
+from typing import Any, TYPE_CHECKING
 from enum import Enum
 
+#  yaml and pydantic are imported where they're used, so the CLI (e.g. shell completion) can
+#  use this module without loading them
+if TYPE_CHECKING:
+    from pydantic import ValidationError
+
 TASK_YES_TOKEN = 'yes'
 TASK_NO_TOKEN = 'no'
 
@@ -52,21 +55,38 @@ def dict_value(d: dict, path: str, require=False, default=None) -> Any:
 _const_vars_map: dict = {}
 _global_vars_map: dict = {}
 _default_vars_map: dict = {}
+#  Expanded values of the default variables scope, valid until the maps change
+_default_vars_memo: dict = {}
+
+
+class AutoVarsKeys(object):
+    TASK_ROOT = "taskRoot"
+    CWD = "cwd"
+    TASK_CLI_ARGS = "cliArgs"
+
+
+def config_const_vars(conf_path: str) -> dict:
+    """Variables set before a configuration file is read, so all of it can use them"""
+    cwd = os.getcwd()
+    return {AutoVarsKeys.CWD: cwd, AutoVarsKeys.TASK_ROOT: os.path.dirname(conf_path) or cwd}
 
 
 def set_const_vars_map(vars_map: dict) -> None:
     global _const_vars_map
     global _default_vars_map
+    global _default_vars_memo
     _const_vars_map = vars_map
     _default_vars_map = vars_map
+    _default_vars_memo = {}
 
 
 def set_global_vars_map(vars_map: dict) -> None:
     global _global_vars_map
     global _default_vars_map
+    global _default_vars_memo
     _global_vars_map = vars_map
-    _default_vars_map = copy.deepcopy(vars_map)
-    _default_vars_map.update(_const_vars_map)
+    _default_vars_map = {**vars_map, **_const_vars_map}
+    _default_vars_memo = {}
 
 
 def dump_vars(vars_map: dict) -> None:
@@ -80,37 +100,105 @@ def dump_default_vars() -> None:
     dump_vars(_default_vars_map)
 
 
+#  Templates compiled by a long running daemon or watcher are bounded, as the expanded strings
+#  come from configurations that may change many times
+_MAX_COMPILED_TEMPLATES = 4096
+
+
+@functools.lru_cache(maxsize=_MAX_COMPILED_TEMPLATES)
+def _compile_template(s: str) -> tuple[tuple[bool, str], ...]:
+    """A template string as a tuple of (is_var, text) segments"""
+    segments = []
+    pos = 0
+    for match in StringVarExpander.var_re.finditer(s):
+        if match.start() > pos:
+            segments.append((False, s[pos:match.start()]))
+        segments.append((True, match.group()[2:-2]))
+        pos = match.end()
+    if pos < len(s):
+        segments.append((False, s[pos:]))
+    return tuple(segments)
+
+
+def template_vars(s: str) -> list[str]:
+    """Names of the variables referenced by a template string"""
+    if "{{" not in s:
+        return []
+    return [text for is_var, text in _compile_template(s) if is_var]
+
+
 class StringVarExpander:
+    """Expands '{{var}}' references in strings.
+
+    Template strings are compiled once into literal and variable segments, and every variable is
+    expanded once per scope (the default scope, or a task's variables on top of it).
+    """
     var_re = re.compile(r'{{\S*?}}')
 
     def __init__(self, vars_map: dict | None = None) -> None:
         if not vars_map:
             self.vars_map = _default_vars_map
+            self._memo = _default_vars_memo
         else:
-            self.vars_map = copy.deepcopy(_global_vars_map)
-            self.vars_map.update(vars_map)
-            self.vars_map.update(_const_vars_map)
-
-        self.expansion_stack = []
+            self.vars_map = {**_global_vars_map, **vars_map, **_const_vars_map}
+            self._memo = {}
 
     def __call__(self, s: str) -> str:
-        if self.expansion_stack:
-            raise TaskException("Incomplete variable expansion?")
-        return re.sub(StringVarExpander.var_re, self._expand_re, s)
-
-    def _expand_re(self, match) -> str:
-        var = match.group()[2:-2]
-        if var in self.expansion_stack:
-            raise TaskException(f"Recursive expanded var '{var}'")
-        if var.startswith("$"):
-            return os.getenv(var[1:], "")
+        if "{{" not in s:
+            return s
+        return "".join(self._var_value(text) if is_var else text
+                       for is_var, text in _compile_template(s))
+
+    def _var_segments(self, var: str) -> tuple[tuple[bool, str], ...]:
         value = self.vars_map.get(var, "")
         if type(value) is list or type(value) is dict:
             raise TaskException(f"Var expanded path '{var}' doesn't refer to valid type")
-        self.expansion_stack.append(var)
-        s = re.sub(StringVarExpander.var_re, self._expand_re, str(value))
-        self.expansion_stack.pop()
-        return s
+        return _compile_template(str(value))
+
+    def _var_value(self, var: str) -> str:
+        if var.startswith("$"):
+            return os.getenv(var[1:], "")
+        memo = self._memo
+        value = memo.get(var)
+        if value is not None:
+            return value
+
+        #  Depth first over the variable's references, so loops are found (with their full path)
+        #  before anything is expanded, regardless of the nesting depth
+        path = [var]
+        on_path = {var}
+        frames = [[self._var_segments(var), 0, []]]
+        while frames:
+            frame = frames[-1]
+            segments, i, parts = frame
+            child = None
+            while i < len(segments):
+                is_var, text = segments[i]
+                if not is_var:
+                    parts.append(text)
+                elif text.startswith("$"):
+                    parts.append(os.getenv(text[1:], ""))
+                elif text in memo:
+                    parts.append(memo[text])
+                elif text in on_path:
+                    loop = path[path.index(text):] + [text]
+                    raise TaskException("Recursive expanded var '{}' ({})".format(
+                        text, " -> ".join(loop)))
+                else:
+                    child = text
+                    break
+                i += 1
+            frame[1] = i
+            if child is not None:
+                path.append(child)
+                on_path.add(child)
+                frames.append([self._var_segments(child), 0, []])
+                continue
+            frames.pop()
+            done = path.pop()
+            on_path.discard(done)
+            memo[done] = "".join(parts)
+        return memo[var]
 
 
 def parse_assignment_str(s: str) -> tuple[str, str]:
@@ -137,19 +225,51 @@ class DictDumpFmt(str, Enum):
     YAML = "yaml"
 
 
+class SchemaDumpOpts(str, Enum):
+    ALL = "all"
+    CONFIG = "config"
+    TASK = "task"
+
+
+class CacheActions(str, Enum):
+    STATS = "stats"
+    PRUNE = "prune"
+
+
+class ContainersActions(str, Enum):
+    LIST = "list"
+    STOP = "stop"
+
+
+class DaemonActions(str, Enum):
+    START = "start"
+    STOP = "stop"
+    STATUS = "status"
+
+
+class WatchPolicy(str, Enum):
+    WAIT = "wait"
+    CANCEL = "cancel"
+
+
 def dump_dict(d: dict, sort: bool, fmt: str) -> str:
     if sort:
         d = sort_dict(d)
 
     if fmt == DictDumpFmt.YAML:
+        import yaml
         return yaml.dump(d, sort_keys=False)
     else:
         return json.dumps(d, indent=4)
 
 
-def pydantic_errmsg(ve: ValidationError) -> str:
+def pydantic_errmsg(ve: "ValidationError") -> str:
+    return pydantic_errors_msg(ve.errors())
+
+
+def pydantic_errors_msg(errors: list) -> str:
     errs = []
-    for e in ve.errors():
+    for e in errors:
         try:
             loc_len = len(e["loc"])
             if loc_len == 0:
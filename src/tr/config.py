@@ -1,29 +1,29 @@
-from tr.common import (TaskException, StringVarExpander, set_const_vars_map, set_global_vars_map,
-                       dump_default_vars, pydantic_errmsg)
+from tr.common import (TaskException, StringVarExpander, AutoVarsKeys, config_const_vars,
+                       set_const_vars_map, set_global_vars_map, dump_default_vars, pydantic_errmsg,
+                       pydantic_errors_msg)
 from tr.logTools import info, verbose, logging_enabled_for
+from tr.cache import (ConfigDeps, load_config_cache, save_config_cache, has_completion_index,
+                      save_completion_index)
+from tr.outcache import OutputCacheBackend, output_cache_backend
+from tr.discovery import config_paths, CONF_FILE_NAMES, DFLT_CONF_DIR
+from tr.trace import span
 import logging
 import os
-import pathlib
+import bisect
+import difflib
 import json
 from typing import Any
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
 from argparse import Namespace as Args
-from pydantic import BaseModel, Field, ConfigDict, ValidationError, AliasChoices
-from copy import deepcopy
+from pydantic import BaseModel, Field, ConfigDict, ValidationError, AliasChoices, TypeAdapter
 import yaml
 from enum import Enum
 
 
-_COMMON_CONF_FILES: list[str] = [".tasks.yaml", "tasks.yaml", ".tasks.json", "tasks.json"]
-_DFLT_CONF_DIR = str(pathlib.Path.home()) + "/.config/"
-_DFLT_CONF_FILES = [os.path.join(_DFLT_CONF_DIR, f) for f in _COMMON_CONF_FILES]
-
-
-def _find_default_config_file(directory: str) -> str | None:
-    for f in _COMMON_CONF_FILES:
-        file_path = os.path.join(directory, f)
-        if os.path.isfile(file_path):
-            return file_path
-    return None
+_DFLT_CONF_FILES = [os.path.join(DFLT_CONF_DIR, f) for f in CONF_FILE_NAMES]
+_MAX_INCLUDE_READERS = 8
+#  libyaml based loader, if available, is several times faster
+_YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
 
 
 HIDDEN = "hidden"
@@ -35,6 +35,7 @@ COMMANDS = "commands"
 ENV = "env"
 C_VOLUMES = "c_volumes"
 C_ENV = "c_env"
+_NOT_INHERITED = (HIDDEN, INCLUDE, ABSTRACT, COMMANDS)
 
 
 class _CmdsInherit(str, Enum):
@@ -44,9 +45,25 @@ class _CmdsInherit(str, Enum):
     After = "after"
 
 
+class _ParallelOutput(str, Enum):
+    Prefix = "prefix"
+    Group = "group"
+
+
+class _TimeoutSignal(str, Enum):
+    Term = "SIGTERM"
+    Int = "SIGINT"
+    Hup = "SIGHUP"
+    Quit = "SIGQUIT"
+    Kill = "SIGKILL"
+    Usr1 = "SIGUSR1"
+    Usr2 = "SIGUSR2"
+
+
 class TaskModel(BaseModel):
     model_config = ConfigDict(extra='forbid')
     base: str | None = None
+    depends_on: list[str] = Field(default_factory=list)
     base_cmds: _CmdsInherit = Field(_CmdsInherit.Default,
                                     validation_alias=AliasChoices("base_cmds", "base_commands"))
     short_desc: str | None = Field(None, max_length=75,
@@ -56,14 +73,29 @@ class TaskModel(BaseModel):
     cwd: str | None = None
     shell: bool = False
     shell_path: str | None = None
+    shell_session: bool = False
     env: dict[str, str] = Field(default_factory=dict)
     inherit_os_env: bool = True
     inherit_env: bool = True
     stop_on_error: bool = True
+    parallel: bool = False
+    max_jobs: int | None = Field(None, ge=1)
+    parallel_output: _ParallelOutput = _ParallelOutput.Prefix
+    timeout: float | None = Field(None, gt=0)
+    command_timeout: float | None = Field(None, gt=0)
+    timeout_signal: _TimeoutSignal = _TimeoutSignal.Term
+    timeout_grace: float = Field(10, ge=0)
+    output_log: str | None = None
+    output_log_max_mb: int = Field(100, ge=0)
+    output_log_keep: int = Field(5, ge=0)
+    output_log_gzip: bool = False
     hidden: bool = False
     abstract: bool = False
     variables: dict[str, str] = Field(default_factory=dict)
     inherit_variables: bool = True
+    matrix: dict[str, list[str]] = Field(default_factory=dict)
+    matrix_exclude: list[dict[str, str]] = Field(default_factory=list)
+    matrix_include: list[dict[str, str]] = Field(default_factory=list)
     #  Container related
     c_image: str | None = None
     c_container_tool: str | None = None
@@ -80,6 +112,13 @@ class TaskModel(BaseModel):
     c_env: dict[str, str] = Field(default_factory=dict)
     c_inherit_env: bool = True
     c_cwd: str | None = None
+    c_session: bool = False
+    c_pool: bool = False
+    c_pool_ttl: int = Field(600, ge=0)
+    #  Up-to-date checks
+    inputs: list[str] = Field(default_factory=list)
+    outputs: list[str] = Field(default_factory=list)
+    cache_outputs: bool = False
 
 
 class ConfigFileModel(BaseModel):
@@ -94,6 +133,8 @@ class ConfigFileModel(BaseModel):
     default_shell_path: str = Field("/bin/sh", max_length=255)
     default_container_tool: str = Field("/usr/bin/docker", max_length=255)
     default_container_shell_path: str = Field("/bin/sh", max_length=255)
+    output_cache_dir: str | None = None
+    output_cache_size_mb: int = Field(1024, ge=0)
 
 
 def validate_config_file_schema(data: dict) -> ConfigFileModel:
@@ -104,12 +145,271 @@ def validate_config_file_schema(data: dict) -> ConfigFileModel:
         raise TaskException(f"Schema validation error: {s}")
 
 
+def _task_model_errmsg(name: str, s: str) -> str:
+    return f"Task schema validation error for '{name}:'\n{s}"
+
+
 def validate_task_model(name: str, data: dict) -> TaskModel:
     try:
         return TaskModel(**data)
     except ValidationError as e:
-        s = pydantic_errmsg(e)
-        raise TaskException(f"Task schema validation error for '{name}:'\n{s}")
+        raise TaskException(_task_model_errmsg(name, pydantic_errmsg(e)))
+
+
+_TASK_MODELS_ADAPTER = TypeAdapter(dict[str, TaskModel])
+
+
+def validate_task_models(tasks: dict) -> tuple[dict[str, TaskModel], dict[str, str]]:
+    """Validate many task descriptors in one pass. Returns models and errors, by task name."""
+    try:
+        return _TASK_MODELS_ADAPTER.validate_python(tasks), {}
+    except ValidationError as e:
+        task_errors: dict[str, list] = {}
+        for err in e.errors():
+            #  Task names are validated as strings when the file is read
+            name = str(err["loc"][0])
+            task_errors.setdefault(name, []).append({**err, "loc": err["loc"][1:]})
+    errors = {name: _task_model_errmsg(name, pydantic_errors_msg(errs))
+              for name, errs in task_errors.items()}
+    valid = {name: desc for name, desc in tasks.items() if name not in errors}
+    return _TASK_MODELS_ADAPTER.validate_python(valid), errors
+
+
+class TaskNameIndex(object):
+    """Sorted index of task names, for exact, abbreviated and approximate lookups."""
+    _MAX_LISTED_CANDIDATES = 10
+
+    def __init__(self, names) -> None:
+        self._names = frozenset(names)
+        self._sorted = sorted(self._names)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._names
+
+    def candidates(self, prefix: str) -> list[str]:
+        start = bisect.bisect_left(self._sorted, prefix)
+        #  All names starting with the prefix are sorted before prefix + the max code point
+        end = bisect.bisect_left(self._sorted, prefix + "\U0010ffff", lo=start)
+        return self._sorted[start:end]
+
+    def suggestions(self, name: str, count: int = 3) -> list[str]:
+        return difflib.get_close_matches(name, self._sorted, n=count)
+
+    def full_name(self, name: str) -> str:
+        if name in self._names:
+            return name
+        start = bisect.bisect_left(self._sorted, name)
+        if start < len(self._sorted) and self._sorted[start].startswith(name):
+            if start + 1 == len(self._sorted) or not self._sorted[start + 1].startswith(name):
+                return self._sorted[start]
+            names = self.candidates(name)
+            listed = ", ".join(names[:self._MAX_LISTED_CANDIDATES])
+            if len(names) > self._MAX_LISTED_CANDIDATES:
+                listed += ", ..."
+            raise TaskException(f"Ambiguous task name '{name}' (candidates: {listed})")
+        err = f"No such task '{name}'"
+        suggestions = self.suggestions(name)
+        if suggestions:
+            err += " (did you mean {}?)".format(", ".join(f"'{s}'" for s in suggestions))
+        raise TaskException(err)
+
+
+def _base_task_name(desc: Any) -> str | None:
+    if not isinstance(desc, dict):
+        return None
+    base = desc.get("base")
+    if not isinstance(base, str) or not base.strip():
+        return None
+    return base
+
+
+def _merge_task_desc(task_desc: dict, task_model: TaskModel, base_desc: dict) -> dict:
+    #  Neither task_desc nor base_desc are modified, resolved descriptors are shared
+    unified_desc = {k: v for k, v in base_desc.items() if k not in _NOT_INHERITED}
+
+    tmp_vars = {}
+    if task_model.inherit_variables:
+        tmp_vars.update(base_desc.get(VARIABLES, {}))
+    tmp_vars.update(task_model.variables)
+
+    tmp_env = {}
+    if task_model.inherit_env:
+        tmp_env.update(base_desc.get(ENV, {}))
+    tmp_env.update(task_model.env)
+
+    tmp_c_env = {}
+    if task_model.c_inherit_env:
+        tmp_c_env.update(base_desc.get(C_ENV, {}))
+    tmp_c_env.update(task_model.c_env)
+
+    tmp_volumes = list(task_model.c_volumes)
+    if task_model.c_inherit_volumes:
+        tmp_volumes += base_desc.get(C_VOLUMES, [])
+
+    base_commands = base_desc.get(COMMANDS, [])
+    commands = []
+    if not task_model.commands:
+        if task_model.base_cmds == _CmdsInherit.Default:
+            commands = list(base_commands)
+        elif task_model.base_cmds != _CmdsInherit.Ignore:
+            commands = task_model.commands
+    elif base_commands:
+        if task_model.base_cmds == _CmdsInherit.Before:
+            commands = base_commands + task_model.commands
+        elif task_model.base_cmds == _CmdsInherit.After:
+            commands = task_model.commands + base_commands
+        else:
+            commands = task_model.commands
+
+    unified_desc.update(task_desc)
+    unified_desc[COMMANDS] = commands
+    unified_desc[VARIABLES] = tmp_vars
+    unified_desc[ENV] = tmp_env
+    unified_desc[C_ENV] = tmp_c_env
+    unified_desc[C_VOLUMES] = tmp_volumes
+    return unified_desc
+
+
+class TaskResolver(object):
+    """Resolves task inheritance for all tasks of a configuration.
+
+    The 'base' graph is analyzed once; every task is then resolved exactly once, on top of its
+    already resolved base. Raw descriptors are all validated once, up front. Resolved descriptors
+    and models are shared, and must not be modified.
+    """
+
+    def __init__(self, tasks: dict, names: TaskNameIndex) -> None:
+        self._tasks = tasks
+        self._models, self._model_errors = validate_task_models(tasks)
+        self._resolved_models: dict[str, TaskModel] = {}
+        self._descs: dict[str, dict] = {}
+        self._errors: dict[str, str] = {}
+        #  Task name -> full base task name, or a lookup error string
+        self._bases: dict[str, str | TaskException | None] = {}
+        for name, desc in tasks.items():
+            base = _base_task_name(desc)
+            if base is None:
+                self._bases[name] = None
+                continue
+            try:
+                self._bases[name] = names.full_name(base)
+            except TaskException as e:
+                self._bases[name] = e
+        self.order, self.loops = self._sort()
+
+    def _sort(self) -> tuple[list[str], list[list[str]]]:
+        """Topologically sort the tasks, bases first. Returns the order and all loops."""
+        order = []
+        loops = []
+        state: dict[str, int] = {}  # 1 - in current path, 2 - done
+        for name in self._tasks:
+            path = []
+            n = name
+            while n is not None and n not in state:
+                state[n] = 1
+                path.append(n)
+                base = self._bases[n]
+                n = base if isinstance(base, str) else None
+            if n is not None and state[n] == 1:
+                loops.append(path[path.index(n):])
+            for n in reversed(path):
+                state[n] = 2
+                order.append(n)
+        return order, loops
+
+    def _resolve_one(self, name: str) -> None:
+        desc = self._tasks[name]
+        try:
+            model = self.raw_model(name)
+            base = self._bases[name]
+            if isinstance(base, TaskException):
+                raise base
+            if base is None:
+                self._descs[name] = desc
+                return
+            if base in self._errors:
+                raise TaskException(self._errors[base])
+            self._descs[name] = _merge_task_desc(desc, model, self._descs[base])
+        except TaskException as e:
+            self._errors[name] = str(e)
+
+    def _resolve_loop(self, loop: list[str]) -> None:
+        #  Every task in the loop reports the first error found walking the loop from it
+        errors = {t: self._model_errors[t] for t in loop if t in self._model_errors}
+        for i, t in enumerate(loop):
+            for walked in loop[i:] + loop[:i]:
+                if walked in errors:
+                    self._errors[t] = errors[walked]
+                    break
+            else:
+                self._errors[t] = f"Inheritance loop detected for task '{t}'"
+
+    def resolve(self, name: str) -> dict:
+        if name not in self._descs and name not in self._errors:
+            #  Walk up to the first resolved ancestor (or root), then resolve downwards
+            chain = []
+            n = name
+            while n not in self._descs and n not in self._errors:
+                if n in chain:
+                    loop_start = chain.index(n)
+                    self._resolve_loop(chain[loop_start:])
+                    chain = chain[:loop_start]
+                    break
+                chain.append(n)
+                base = self._bases[n]
+                if not isinstance(base, str):
+                    break
+                n = base
+            for t in reversed(chain):
+                self._resolve_one(t)
+        if name in self._errors:
+            raise TaskException(self._errors[name])
+        return self._descs[name]
+
+    def raw_model(self, name: str) -> TaskModel:
+        """Model of the task's own descriptor, without inheritance"""
+        error = self._model_errors.get(name)
+        if error is not None:
+            raise TaskException(error)
+        return self._models[name]
+
+    def model(self, name: str) -> TaskModel:
+        """Model of the task's resolved descriptor"""
+        model = self._resolved_models.get(name)
+        if model is None:
+            desc = self.resolve(name)
+            if desc is self._tasks[name]:
+                model = self._models[name]
+            else:
+                model = validate_task_model(name, desc)
+            self._resolved_models[name] = model
+        return model
+
+    def resolve_all(self) -> None:
+        for name in self.order:
+            try:
+                self.model(name)
+            except TaskException:
+                pass
+
+    def errors(self) -> dict[str, str]:
+        """Errors of all tasks, by task name. Resolves all tasks."""
+        self.resolve_all()
+        return dict(self._errors)
+
+
+def _completions(tasks: dict, resolver: TaskResolver) -> dict[str, str]:
+    """Visible task names, with their short descriptions. Tasks with errors aren't included,
+    as they can't be run anyway."""
+    completions = {}
+    for name in tasks:
+        try:
+            model = resolver.model(name)
+        except TaskException:
+            continue
+        if not model.hidden and not model.abstract:
+            completions[name] = model.short_desc or ""
+    return completions
 
 
 class Config:
@@ -119,91 +419,160 @@ class Config:
         try:
             ext = os.path.splitext(file_path)[1]
             if ext == ".json":
-                data: dict = json.load(open(file_path, 'r'))
+                with open(file_path, 'r') as f:
+                    data: dict = json.load(f)
             elif ext == ".yaml" or ext == ".yml":
-                data: dict = yaml.safe_load(open(file_path, 'r')) or {}
+                with open(file_path, 'r') as f:
+                    data: dict = yaml.load(f, Loader=_YamlLoader) or {}
             else:
                 raise TaskException("Unsupported configuration file format")
             return validate_config_file_schema(data)
         except (IOError, TypeError, ValueError, TaskException, IndexError, yaml.YAMLError) as e:
             raise TaskException(f"Error parsing {file_path} - {e}")
 
-    def _read_configuration(self, file_path: str, read_files: set | None = None) -> ConfigFileModel:
-        if read_files is None:
-            read_files = set()
-        includes = []
-        base_config_model = None
-        info("Reading configuration file {}", file_path)
-        base_config_model = Config._read_config_file(file_path)
-        includes = base_config_model.includes
-
+    def _read_configuration(self, conf_path: str) -> ConfigFileModel:
+        with span("read_config", file=conf_path):
+            models, includes = self._read_include_graph(conf_path)
+        with span("merge_config", files=len(models)):
+            return self._merge_includes(conf_path, models, includes)
+
+    def _read_include_graph(self, conf_path: str) -> tuple[dict, dict]:
+        """Read every file in the include graph of 'conf_path' once, included files concurrently.
+
+        Returns the parsed model (or parsing error) of every file, and the expanded includes of
+        every file that was parsed.
+        """
+        info("Reading configuration file {}", conf_path)
+        self.deps.add_file(conf_path)
+        conf_model = Config._read_config_file(conf_path)
         # Add the default configuration file to includes list but only for the original
-        # configuration file, and the behavior isn't turned off (again, relevant ONLY to
-        # original file)
-        dflt_conf_file_path = _find_default_config_file(_DFLT_CONF_DIR)
-        if len(read_files) == 0 and \
-                file_path not in _DFLT_CONF_FILES and \
-                dflt_conf_file_path and \
-                base_config_model.use_default_include:
-            includes.insert(0, dflt_conf_file_path)
-
-        included_tasks = {}
-        included_variables = {}
-        info(f"Configuration file includes: {includes}")
-        read_files.add(file_path)
+        # configuration file, and the behavior isn't turned off
+        self.deps.dflt_conf_file = self._dflt_conf_file
+        if conf_path not in _DFLT_CONF_FILES and self._dflt_conf_file and \
+                conf_model.use_default_include:
+            conf_model.includes.insert(0, self._dflt_conf_file)
+
+        models: dict[str, ConfigFileModel | TaskException] = {conf_path: conf_model}
+        includes: dict[str, list[str]] = {}
         expander = StringVarExpander()
-        for f in includes:
-            f = expander(f)
-            if f in read_files:
-                raise TaskException(f"Include loop detected - '{f}'")
-            included_model = self._read_configuration(f, read_files)
-            included_tasks.update(included_model.tasks)
-            included_variables.update(included_model.variables)
-        included_tasks.update(base_config_model.tasks)
-        included_variables.update(base_config_model.variables)
-
-        base_config_model.tasks = included_tasks
-        base_config_model.variables = included_variables
-        return base_config_model
-
-    @staticmethod
-    def _get_conf_file_path() -> str | None:
-        directory = os.getcwd()
-        while True:
-            conf_path = _find_default_config_file(directory)
-            if conf_path:
-                return conf_path
-            if directory == "/":
-                break
-            directory = os.path.dirname(directory)
-
-        return _find_default_config_file(_DFLT_CONF_DIR)
-
-    def __init__(self, args: Args | None) -> None:
+        ready = [conf_path]
+        pending: dict[Future, str] = {}
+        with ThreadPoolExecutor(max_workers=_MAX_INCLUDE_READERS) as executor:
+            while True:
+                for path in ready:
+                    model = models[path]
+                    if isinstance(model, TaskException):
+                        continue
+                    info("Configuration file {} includes: {}", path, model.includes)
+                    includes[path] = []
+                    for raw_f in model.includes:
+                        f = expander(raw_f)
+                        self.deps.add_include(raw_f, f)
+                        includes[path].append(f)
+                        if f in models or f in pending.values():
+                            continue
+                        info("Reading configuration file {}", f)
+                        self.deps.add_file(f)
+                        pending[executor.submit(Config._read_config_file, f)] = f
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                ready = []
+                for future in done:
+                    path = pending.pop(future)
+                    try:
+                        models[path] = future.result()
+                    except TaskException as e:
+                        models[path] = e
+                    ready.append(path)
+        return models, includes
+
+    def _include_order(self, path: str, includes: dict, models: dict, order: dict,
+                       on_path: set) -> None:
+        """Add the files 'path' includes, depth first, and then 'path' itself to 'order'. A file
+        included more than once keeps its first position only."""
+        on_path.add(path)
+        for f in includes[path]:
+            try:
+                if f in on_path:
+                    raise TaskException(f"Include loop detected - '{f}'")
+                if f in order:
+                    continue
+                if isinstance(models[f], TaskException):
+                    raise models[f]
+            except TaskException as e:
+                if self.include_errors is None:
+                    raise
+                if str(e) not in self.include_errors:
+                    self.include_errors.append(str(e))
+                continue
+            self._include_order(f, includes, models, order, on_path)
+        on_path.discard(path)
+        order[path] = None
+
+    def _merge_includes(self, conf_path: str, models: dict, includes: dict) -> ConfigFileModel:
+        """Merge the tasks and variables of all files in the include graph into the main file's
+        model. Files later in the include order override earlier ones."""
+        order: dict[str, None] = {}
+        self._include_order(conf_path, includes, models, order, set())
+        tasks = {}
+        variables = {}
+        for path in order:
+            tasks.update(models[path].tasks)
+            variables.update(models[path].variables)
+        model = models[conf_path]
+        model.tasks = tasks
+        model.variables = variables
+        return model
+
+    def _load_configuration(self, conf_path: str) -> ConfigFileModel:
+        use_cache = not (self.args and self.args.no_cache)
+        if use_cache:
+            with span("load_config_cache", file=conf_path):
+                cached = load_config_cache(conf_path, StringVarExpander(), self._dflt_conf_file)
+            if cached is not None:
+                self.deps, (conf, self._names, resolver) = cached
+                self._resolver = resolver
+                if not has_completion_index(conf_path):
+                    save_completion_index(conf_path, self.deps, _completions(conf.tasks, resolver))
+                return conf
+
+        self.deps = ConfigDeps()
+        conf = self._read_configuration(conf_path)
+        if use_cache and not self.include_errors:
+            #  Resolve all tasks up front so warm loads get them for free
+            self._names = TaskNameIndex(conf.tasks)
+            self._resolver = TaskResolver(conf.tasks, self._names)
+            with span("resolve_all", tasks=len(conf.tasks)):
+                self._resolver.resolve_all()
+            with span("save_config_cache", file=conf_path):
+                save_config_cache(conf_path, self.deps, (conf, self._names, self._resolver))
+                save_completion_index(conf_path, self.deps,
+                                      _completions(conf.tasks, self._resolver))
+        return conf
+
+    def __init__(self, args: Args | None, collect_errors: bool = False) -> None:
         self.args: Args = args  # type: ignore
-        if args and args.conf:
-            conf_path = args.conf
-        else:
-            conf_path = Config._get_conf_file_path()
+        with span("discover_config"):
+            conf_path, self._dflt_conf_file = config_paths(args.conf if args else None,
+                                                           use_cache=not (args and args.no_cache))
 
         if not conf_path:
             raise TaskException("No task configuration file found")
 
         #  Populate some variables early so they are available for the rest of the configuration
-        const_vars = {}
-        cwd = os.getcwd()
-        const_vars[AutoVarsKeys.CWD] = cwd
-        conf_dir_name = os.path.dirname(conf_path)
-        if conf_dir_name:
-            const_vars[AutoVarsKeys.TASK_ROOT] = os.path.dirname(conf_path)
-        else:
-            const_vars.setdefault(AutoVarsKeys.TASK_ROOT, cwd)
+        const_vars = config_const_vars(conf_path)
         if args and args.__contains__(AutoVarsKeys.TASK_CLI_ARGS):
             const_vars[AutoVarsKeys.TASK_CLI_ARGS] = " ".join(
                 args.__getattribute__(AutoVarsKeys.TASK_CLI_ARGS))
         set_const_vars_map(const_vars)
+        self.task_root: str = const_vars[AutoVarsKeys.TASK_ROOT]
 
-        self.conf = self._read_configuration(conf_path)
+        self._names: TaskNameIndex | None = None
+        self._resolver: TaskResolver | None = None
+        #  When collecting (not None), bad includes are skipped instead of failing the load
+        self.include_errors: list[str] | None = [] if collect_errors else None
+        self.conf = self._load_configuration(conf_path)
 
         set_global_vars_map(self.conf.variables)
 
@@ -229,96 +598,39 @@ class Config:
     def default_shell_path(self) -> str:
         return self.conf.default_shell_path
 
-    def visible_tasks(self) -> list[str]:
-        tasks = set()
-        for name, task in self.tasks.items():
-            if not task.get(HIDDEN, False):
-                tasks.add(name)
-        return list(tasks)
-
-    def _raw_task_obj(self, name: str) -> dict:
-        if name in self.tasks:
-            return self.tasks[name]
-        tasks = [t for t in self.tasks if t.startswith(name)]
-        if len(tasks) == 1:
-            return self.tasks[tasks[0]]
-        if len(tasks) > 1:
-            raise TaskException(f"Ambiguous task name '{name}'")
-        raise TaskException(f"No such task '{name}'")
-
-    def task_desc(self, name: str, included_list: set | None) -> dict:
-
-        if included_list is not None:
-            if name in included_list:
-                raise TaskException(f"Inheritance loop detected for task '{name}'")
-            included_list.add(name)
-
-        task_desc = self._raw_task_obj(name)
-        task_model = validate_task_model(name, task_desc)
-        base_task_name = task_model.base
-        if included_list is None or base_task_name is None or not base_task_name.strip():
-            return task_desc
-
-        base_task_desc = self.task_desc(base_task_name, included_list)
-        base_task_desc = deepcopy(base_task_desc)
-        base_task_desc.pop(HIDDEN, None)
-        base_task_desc.pop(INCLUDE, None)
-        base_task_desc.pop(ABSTRACT, None)
-
-        tmp_vars = {}
-        if task_model.inherit_variables:
-            tmp_vars.update(base_task_desc.get(VARIABLES, {}))
-        tmp_vars.update(task_model.variables)
-
-        tmp_env = {}
-        if task_model.inherit_env:
-            tmp_env.update(base_task_desc.get(ENV, {}))
-        tmp_env.update(task_model.env)
-
-        tmp_c_env = {}
-        if task_model.c_inherit_env:
-            tmp_c_env.update(base_task_desc.get(C_ENV, {}))
-        tmp_c_env.update(task_model.c_env)
-
-        tmp_volumes = task_model.c_volumes
-        if task_model.c_inherit_volumes:
-            task_model.c_volumes += base_task_desc.get(C_VOLUMES, [])
-
-        base_commands = base_task_desc.pop(COMMANDS, [])
-        commands = []
-        if not task_model.commands:
-            if task_model.base_cmds == _CmdsInherit.Default:
-                commands = base_commands
-            elif task_model.base_cmds != _CmdsInherit.Ignore:
-                commands = task_model.commands
-        elif base_commands:
-            if task_model.base_cmds == _CmdsInherit.Before:
-                commands = base_commands + task_model.commands
-            elif task_model.base_cmds == _CmdsInherit.After:
-                commands = task_model.commands + base_commands
-            else:
-                commands = task_model.commands
-
-        unified_desc = {}
-        unified_desc.update(base_task_desc)
-        unified_desc.update(task_desc)
-        unified_desc[COMMANDS] = commands
-        unified_desc[VARIABLES] = tmp_vars
-        unified_desc[ENV] = tmp_env
-        unified_desc[C_ENV] = tmp_c_env
-        unified_desc[C_VOLUMES] = tmp_volumes
-        return unified_desc
+    def output_cache(self) -> OutputCacheBackend:
+        path = self.conf.output_cache_dir
+        if path:
+            path = StringVarExpander()(path)
+        return output_cache_backend(path, self.conf.output_cache_size_mb)
 
-    def task_model(self, name: str, includes: bool) -> TaskModel:
-        verbose("Task '{}' requested, with_inclusions={}", name, includes)
-        if includes:
-            desc = self.task_desc(name, set())
-        else:
-            desc = self.task_desc(name, None)
-        return validate_task_model(name, desc)
+    def completions(self) -> dict[str, str]:
+        return _completions(self.tasks, self.resolver)
+
+    @property
+    def names(self) -> TaskNameIndex:
+        if self._names is None:
+            self._names = TaskNameIndex(self.tasks)
+        return self._names
 
+    @property
+    def resolver(self) -> TaskResolver:
+        if self._resolver is None:
+            self._resolver = TaskResolver(self.tasks, self.names)
+        return self._resolver
+
+    def task_desc(self, name: str, includes: bool) -> dict:
+        with span("task_desc", task=name, includes=includes):
+            full_name = self.names.full_name(name)
+            if not includes:
+                self.resolver.raw_model(full_name)
+                return self.tasks[full_name]
+            return self.resolver.resolve(full_name)
 
-class AutoVarsKeys(object):
-    TASK_ROOT = "taskRoot"
-    CWD = "cwd"
-    TASK_CLI_ARGS = "cliArgs"
+    def task_model(self, name: str, includes: bool) -> TaskModel:
+        verbose("Task '{}' requested, with_inclusions={}", name, includes)
+        with span("task_model", task=name, includes=includes):
+            full_name = self.names.full_name(name)
+            if not includes:
+                return self.resolver.raw_model(full_name)
+            return self.resolver.model(full_name)
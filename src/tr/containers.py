@@ -0,0 +1,195 @@
+from tr.logTools import info, warn
+from tr.common import TaskException
+from tr.cache import cache_dir, write_atomic
+import os
+import sys
+import json
+import time
+import fcntl
+import hashlib
+import subprocess
+from typing import Callable
+
+_POOL_SUBDIR = "containers"
+_POOL_PREFIX = "tr-pool-"
+
+
+def _pool_dir() -> str:
+    return os.path.join(cache_dir(), _POOL_SUBDIR)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class _StateLock(object):
+    def __init__(self, name: str) -> None:
+        os.makedirs(_pool_dir(), exist_ok=True)
+        self._path = os.path.join(_pool_dir(), f"{name}.lock")
+        self._fd = -1
+
+    def __enter__(self) -> "_StateLock":
+        self._fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *_) -> None:
+        os.close(self._fd)  # Releases the lock
+
+
+def _state_path(name: str) -> str:
+    return os.path.join(_pool_dir(), f"{name}.json")
+
+
+def _load_state(name: str) -> dict | None:
+    try:
+        with open(_state_path(name), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_state(state: dict) -> None:
+    write_atomic(_state_path(state["name"]), json.dumps(state).encode())
+
+
+def _remove_container(state: dict) -> None:
+    info("Removing pool container '{}'", state["name"])
+    try:
+        subprocess.run(state["tool"] + ["rm", "-f", state["name"]], stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+    except OSError as e:
+        warn("Failed to remove container '{}' - {}", state["name"], e)
+    try:
+        os.unlink(_state_path(state["name"]))
+    except FileNotFoundError:
+        pass
+
+
+def _container_running(tool: list[str], name: str) -> bool:
+    try:
+        p = subprocess.run(tool + ["inspect", "-f", "{{.State.Running}}", name],
+                           stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    except OSError:
+        return False
+    return p.returncode == 0 and p.stdout.strip() == "true"
+
+
+class ContainerPool(object):
+    """A named container shared by all task runs with the same container settings.
+
+    The container is kept running until it's idle (no task is using it) for 'ttl' seconds. Its
+    state (users and last use time) is kept in a file under the cache directory, protected by a
+    file lock, and a detached reaper process removes it once it's expired.
+    """
+
+    def __init__(self, tool: list[str], image: str, key_data: dict, ttl: int) -> None:
+        self.tool = tool
+        self.image = image
+        self.ttl = ttl
+        key = hashlib.sha256(json.dumps(key_data, sort_keys=True).encode()).hexdigest()
+        self.name = _POOL_PREFIX + key[:16]
+
+    def acquire(self, run_cmd: Callable[[str], list[str]]) -> str:
+        """Get the pool container name, starting it (with 'run_cmd(name)') if needed."""
+        with _StateLock(self.name):
+            state = _load_state(self.name)
+            if state is None or not _container_running(self.tool, self.name):
+                if state is not None:
+                    info("Pool container '{}' isn't running", self.name)
+                    subprocess.run(self.tool + ["rm", "-f", self.name], stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.DEVNULL)
+                cmd_array = run_cmd(self.name)
+                info("Starting pool container: {}", cmd_array)
+                try:
+                    p = subprocess.run(cmd_array, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                       text=True)
+                except OSError as e:
+                    raise TaskException(f"Error starting pool container - {e}")
+                if p.returncode != 0:
+                    raise TaskException(f"Error starting pool container - {p.stderr.strip()}")
+                state = {"name": self.name, "tool": self.tool, "image": self.image,
+                         "created": time.time(), "users": [], "reaper": 0}
+            else:
+                info("Reusing pool container '{}'", self.name)
+            state["users"] = [pid for pid in state["users"] if _pid_alive(pid)] + [os.getpid()]
+            state["ttl"] = self.ttl
+            state["last_used"] = time.time()
+            _save_state(state)
+        return self.name
+
+    def release(self) -> None:
+        with _StateLock(self.name):
+            state = _load_state(self.name)
+            if state is None:
+                return
+            pid = os.getpid()
+            state["users"] = [p for p in state["users"] if p != pid and _pid_alive(p)]
+            state["last_used"] = time.time()
+            if not state["users"] and not (state["reaper"] and _pid_alive(state["reaper"])):
+                state["reaper"] = _spawn_reaper(self.name)
+            _save_state(state)
+
+
+def _spawn_reaper(name: str) -> int:
+    try:
+        p = subprocess.Popen([sys.executable, "-m", "tr.containers", name],
+                             stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                             stderr=subprocess.DEVNULL, start_new_session=True)
+    except OSError as e:
+        warn("Failed to start pool container reaper - {}", e)
+        return 0
+    info("Started reaper (pid={}) for pool container '{}'", p.pid, name)
+    return p.pid
+
+
+def _reap(name: str) -> None:
+    while True:
+        with _StateLock(name):
+            state = _load_state(name)
+            if state is None or state["reaper"] != os.getpid():
+                return
+            state["users"] = [pid for pid in state["users"] if _pid_alive(pid)]
+            idle = time.time() - state["last_used"]
+            if not state["users"] and idle >= state["ttl"]:
+                _remove_container(state)
+                return
+            _save_state(state)
+            wait = state["ttl"] if state["users"] else state["ttl"] - idle
+        time.sleep(max(wait, 1))
+
+
+def pool_containers() -> list[dict]:
+    states = []
+    try:
+        names = sorted(os.listdir(_pool_dir()))
+    except FileNotFoundError:
+        return []
+    for f in names:
+        if not f.endswith(".json"):
+            continue
+        state = _load_state(f[:-len(".json")])
+        if state is None:
+            continue
+        state["users"] = [pid for pid in state["users"] if _pid_alive(pid)]
+        states.append(state)
+    return states
+
+
+def stop_pool_container(name: str) -> bool:
+    with _StateLock(name):
+        state = _load_state(name)
+        if state is None:
+            return False
+        _remove_container(state)
+    return True
+
+
+if __name__ == "__main__":
+    _reap(sys.argv[1])
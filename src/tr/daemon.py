@@ -0,0 +1,222 @@
+from tr.logTools import info, init_logging
+from tr.common import TaskException
+from tr.cache import (enable_memory_cache, memory_cache_entries, drop_memory_cache_entries,
+                      file_stamp)
+from tr.client import socket_path, daemon_request, recv_msg, send_msg, code_stamp
+from tr.inotify import Inotify
+from tr import version
+import os
+import io
+import sys
+import time
+import socket
+import selectors
+import subprocess
+import contextlib
+
+#  Subcommands answered by the daemon itself. 'run' is answered with a plan of commands
+_SERVED_CMDS = {"list", "info", "dump", "dump_config", "check"}
+_START_TIMEOUT_SECS = 5.0
+
+
+@contextlib.contextmanager
+def _client_context(cwd: str, env: dict):
+    """Run as if in the client process: its working directory and environment."""
+    orig_cwd = os.getcwd()
+    orig_env = dict(os.environ)
+    os.chdir(cwd)
+    os.environ.clear()
+    os.environ.update(env)
+    try:
+        yield
+    finally:
+        os.environ.clear()
+        os.environ.update(orig_env)
+        os.chdir(orig_cwd)
+
+
+class Daemon(object):
+    """Serves 'task' CLI requests, keeping parsed configurations in memory."""
+
+    def __init__(self) -> None:
+        self.path = socket_path()
+        self._inotify = Inotify.create()
+        self._stopped = False
+        self._started = time.time()
+        self._served = 0
+        self._code = code_stamp()
+        enable_memory_cache(watched=self._inotify is not None)
+
+    def _bind(self) -> socket.socket:
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        if daemon_request({"op": "status"}, timeout=1.0) is not None:
+            raise TaskException(f"A daemon is already listening on '{self.path}'")
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        os.chmod(self.path, 0o600)
+        sock.listen(16)
+        return sock
+
+    def _sync_watches(self) -> None:
+        """Watch the directories of all cached configuration files."""
+        if self._inotify is None:
+            return
+        for _, (deps, _) in list(memory_cache_entries().items()):
+            for stamp in deps.files:
+                if not self._inotify.watch(os.path.dirname(stamp[0])):
+                    continue
+                #  Changes made before the watch was added would go unnoticed
+                if file_stamp(stamp[0]) != stamp:
+                    drop_memory_cache_entries(stamp[0])
+
+    def _on_fs_events(self) -> None:
+        assert self._inotify
+        paths = self._inotify.read()
+        if paths is None:
+            info("inotify events were lost")
+            drop_memory_cache_entries()
+            return
+        for path in paths:
+            drop_memory_cache_entries(path)
+
+    def _cli(self, req: dict) -> dict:
+        from tr.__main__ import parse_arguments, dispatch
+        from tr.actions import run_plan
+        from tr.config import Config
+
+        out = io.StringIO()
+        err = io.StringIO()
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+            try:
+                args = parse_arguments(req["argv"])
+            except TaskException:
+                #  Usage errors, '--help' and such are left for the client
+                return {"fallback": True}
+            if args.log_file or args.trace or args.stats or \
+                    args.subparsers_name not in _SERVED_CMDS | {"run"}:
+                return {"fallback": True}
+            try:
+                if args.subparsers_name == "run":
+                    plan = run_plan(Config(args))
+                    if plan is None:
+                        return {"fallback": True}
+                    return {"plan": plan, "stdout": out.getvalue(), "stderr": err.getvalue()}
+                rc = dispatch(args)
+            except TaskException as e:
+                print(str(e))
+                rc = 255
+        return {"rc": rc, "stdout": out.getvalue(), "stderr": err.getvalue()}
+
+    def _complete(self) -> dict:
+        from tr.config import Config
+        try:
+            return {"tasks": Config(None).completions()}
+        except TaskException:
+            return {"tasks": {}}
+
+    def _handle(self, req: dict) -> dict:
+        op = req.get("op")
+        if op == "status":
+            return {"pid": os.getpid(), "version": version, "uptime": time.time() - self._started,
+                    "served": self._served, "configs": len(memory_cache_entries()),
+                    "watched": self._inotify is not None}
+        if op == "stop":
+            self._stopped = True
+            return {"pid": os.getpid()}
+        if req.get("code") != self._code:
+            info("Client code differs from the daemon's, not serving")
+            return {"fallback": True}
+        with _client_context(req["cwd"], req["env"]):
+            if op == "complete":
+                reply = self._complete()
+            elif op == "cli":
+                reply = self._cli(req)
+            else:
+                reply = {"fallback": True}
+        if not reply.get("fallback"):
+            self._served += 1
+        return reply
+
+    def _serve_one(self, sock: socket.socket) -> None:
+        conn, _ = sock.accept()
+        if self._inotify:
+            #  Events of changes made before the request might not have been handled yet
+            self._on_fs_events()
+        with conn:
+            try:
+                req = recv_msg(conn)
+                info("Daemon request: op={} argv={}", req.get("op"), req.get("argv"))
+                try:
+                    reply = self._handle(req)
+                except Exception as e:
+                    #  Never let a bad request take the daemon down
+                    info("Failed handling request - {}", e)
+                    reply = {"fallback": True}
+                send_msg(conn, reply)
+            except (OSError, ValueError) as e:
+                info("Daemon connection error - {}", e)
+        self._sync_watches()
+
+    def serve(self) -> None:
+        sock = self._bind()
+        info("Daemon (pid={}) listening on '{}'", os.getpid(), self.path)
+        sel = selectors.DefaultSelector()
+        sel.register(sock, selectors.EVENT_READ, lambda: self._serve_one(sock))
+        if self._inotify:
+            sel.register(self._inotify.fd, selectors.EVENT_READ, self._on_fs_events)
+        try:
+            while not self._stopped:
+                for key, _ in sel.select():
+                    key.data()
+        finally:
+            sel.close()
+            sock.close()
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(self.path)
+            info("Daemon stopped")
+
+
+def start_daemon(foreground: bool, log_file: str) -> None:
+    if foreground:
+        Daemon().serve()
+        return
+    if daemon_request({"op": "status"}, timeout=1.0) is not None:
+        raise TaskException("Daemon is already running")
+    cmd = [sys.executable, "-m", "tr.daemon"] + ([os.path.abspath(log_file)] if log_file else [])
+    try:
+        p = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                             stderr=subprocess.DEVNULL, start_new_session=True)
+    except OSError as e:
+        raise TaskException(f"Error starting daemon - {e}")
+    deadline = time.monotonic() + _START_TIMEOUT_SECS
+    while daemon_request({"op": "status"}, timeout=1.0) is None:
+        if p.poll() is not None or time.monotonic() > deadline:
+            raise TaskException("Daemon failed to start")
+        time.sleep(0.05)
+
+
+def stop_daemon() -> bool:
+    reply = daemon_request({"op": "stop"}, timeout=5.0)
+    if reply is None:
+        return False
+    #  The socket is removed once the daemon is done
+    deadline = time.monotonic() + _START_TIMEOUT_SECS
+    while os.path.exists(socket_path()) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return True
+
+
+def daemon_status() -> dict | None:
+    return daemon_request({"op": "status"}, timeout=5.0)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        init_logging(sys.argv[1], 0)
+    try:
+        Daemon().serve()
+    except (TaskException, OSError) as e:
+        info("Daemon failed - {}", e)
+        sys.exit(1)
@@ -0,0 +1,128 @@
+from tr.logTools import info, verbose
+from tr.cache import cache_dir, write_atomic
+import os
+import json
+import time
+import pathlib
+
+CONF_FILE_NAMES: list[str] = [".tasks.yaml", "tasks.yaml", ".tasks.json", "tasks.json"]
+DFLT_CONF_DIR = str(pathlib.Path.home()) + "/.config/"
+#  Directories listed here (os.pathsep separated) are the last ones searched
+CEILING_DIRS_ENV = "TASK_CEILING_DIRS"
+#  When set, a repository root (a directory with '.git' in it) is the last directory searched
+STOP_AT_REPO_ROOT_ENV = "TASK_STOP_AT_REPO_ROOT"
+
+_CACHE_FILE = "discovery.json"
+_CACHE_MAX_ENTRIES = 4096
+#  Directories modified this recently might still change within the same modification time tick
+_RACY_SECS = 2
+_REPO_MARKER = ".git"
+_INTERESTING_NAMES = set(CONF_FILE_NAMES) | {_REPO_MARKER}
+
+
+class ConfigFinder(object):
+    """Finds configuration files, one directory listing (or a single stat) per directory.
+
+    Directory lookup results, positive and negative, are cached by the directory's modification
+    time, which changes whenever entries are added, removed or renamed in it.
+    """
+
+    def __init__(self, use_cache: bool) -> None:
+        self._path = os.path.join(cache_dir(), _CACHE_FILE)
+        self._entries: dict[str, list] | None = self._load() if use_cache else None
+        self._dirty = False
+
+    def _load(self) -> dict[str, list]:
+        try:
+            with open(self._path, "r") as f:
+                entries = json.load(f)
+            if isinstance(entries, dict):
+                return entries
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            info("Ignoring unreadable discovery cache '{}' - {}", self._path, e)
+        return {}
+
+    @staticmethod
+    def _scan(directory: str) -> tuple[str | None, bool]:
+        found = {}
+        try:
+            with os.scandir(directory) as it:
+                for e in it:
+                    if e.name in _INTERESTING_NAMES:
+                        found[e.name] = e
+        except OSError as e:
+            verbose("Can't list '{}' - {}", directory, e)
+            return None, False
+        is_repo_root = _REPO_MARKER in found
+        for name in CONF_FILE_NAMES:
+            e = found.get(name)
+            if e is not None and e.is_file():
+                return name, is_repo_root
+        return None, is_repo_root
+
+    def lookup(self, directory: str) -> tuple[str | None, bool]:
+        """Returns the configuration file in 'directory' (or None), and if it's a repository root"""
+        if self._entries is None:
+            name, is_repo_root = self._scan(directory)
+        else:
+            try:
+                st = os.stat(directory)
+            except OSError:
+                return None, False
+            entry = self._entries.get(directory)
+            if entry and entry[0] == st.st_mtime_ns:
+                name, is_repo_root = entry[1], entry[2]
+            else:
+                name, is_repo_root = self._scan(directory)
+                if time.time() - st.st_mtime > _RACY_SECS:
+                    self._entries.pop(directory, None)
+                    self._entries[directory] = [st.st_mtime_ns, name, is_repo_root]
+                    self._dirty = True
+                elif entry:
+                    del self._entries[directory]
+                    self._dirty = True
+        return (os.path.join(directory, name) if name else None), is_repo_root
+
+    def find(self, start: str) -> str | None:
+        """Search 'start' and its parents for a configuration file, up to the stop boundary."""
+        ceilings = {os.path.normpath(d) for d in os.getenv(CEILING_DIRS_ENV, "").split(os.pathsep)
+                    if d}
+        stop_at_repo_root = bool(os.getenv(STOP_AT_REPO_ROOT_ENV))
+        directory = start
+        while True:
+            conf_path, is_repo_root = self.lookup(directory)
+            if conf_path:
+                return conf_path
+            if directory == "/":
+                break
+            if directory in ceilings or (stop_at_repo_root and is_repo_root):
+                info("Configuration search stopped at '{}'", directory)
+                break
+            directory = os.path.dirname(directory)
+        return None
+
+    def save(self) -> None:
+        if not self._dirty or self._entries is None:
+            return
+        entries = self._entries
+        if len(entries) > _CACHE_MAX_ENTRIES:
+            #  Entries are kept in insertion order, drop the oldest ones
+            entries = dict(list(entries.items())[-_CACHE_MAX_ENTRIES:])
+        try:
+            write_atomic(self._path, json.dumps(entries).encode())
+        except OSError as e:
+            info("Failed to save discovery cache '{}' - {}", self._path, e)
+        self._dirty = False
+
+
+def config_paths(conf: str | None, use_cache: bool) -> tuple[str | None, str | None]:
+    """The configuration file to use ('conf' if set, the one found searching from the working
+    directory otherwise, or the default one), and the default configuration file, if any."""
+    finder = ConfigFinder(use_cache)
+    #  Probed once, used for both the search fallback and includes
+    dflt_conf_file = finder.lookup(DFLT_CONF_DIR)[0]
+    conf_path = conf or finder.find(os.getcwd()) or dflt_conf_file
+    finder.save()
+    return conf_path, dflt_conf_file
@@ -0,0 +1,83 @@
+from tr.logTools import info
+import os
+import ctypes
+import struct
+
+
+class Inotify(object):
+    """Minimal inotify(7) wrapper, watching directories for changed entries."""
+    _IN_MODIFY = 0x2
+    _IN_ATTRIB = 0x4
+    _IN_CLOSE_WRITE = 0x8
+    _IN_MOVED_FROM = 0x40
+    _IN_MOVED_TO = 0x80
+    _IN_CREATE = 0x100
+    _IN_DELETE = 0x200
+    _IN_Q_OVERFLOW = 0x4000
+    _IN_IGNORED = 0x8000
+    _IN_ISDIR = 0x40000000
+    _MASK = _IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | \
+        _IN_CREATE | _IN_DELETE
+    _EVENT_HDR = struct.Struct("iIII")
+
+    def __init__(self) -> None:
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._dirs: dict[int, str] = {}
+        self._watched: set[str] = set()
+
+    @staticmethod
+    def create() -> "Inotify | None":
+        try:
+            return Inotify()
+        except (OSError, AttributeError) as e:
+            info("inotify isn't available - {}", e)
+            return None
+
+    def watch(self, directory: str) -> bool:
+        """Watch 'directory'. Returns True if it wasn't watched before."""
+        if directory in self._watched:
+            return False
+        wd = self._libc.inotify_add_watch(self.fd, directory.encode(), self._MASK)
+        if wd < 0:
+            info("Failed to watch '{}' - {}", directory, os.strerror(ctypes.get_errno()))
+            return False
+        self._dirs[wd] = directory
+        self._watched.add(directory)
+        return True
+
+    def read_events(self) -> list[tuple[str, bool]] | None:
+        """Returns (changed path, is it a new directory) of every event, or None if events were
+        lost."""
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_len = self._EVENT_HDR.unpack_from(data, offset)
+            offset += self._EVENT_HDR.size
+            name = data[offset:offset + name_len].rstrip(b"\0").decode(errors="surrogateescape")
+            offset += name_len
+            if mask & self._IN_Q_OVERFLOW:
+                return None
+            directory = self._dirs.get(wd)
+            if mask & self._IN_IGNORED:
+                #  The watch was removed (e.g. the directory was deleted)
+                if directory is not None:
+                    del self._dirs[wd]
+                    self._watched.discard(directory)
+                continue
+            if directory is not None:
+                new_dir = bool(mask & self._IN_ISDIR) and \
+                    bool(mask & (self._IN_CREATE | self._IN_MOVED_TO))
+                events.append((os.path.join(directory, name), new_dir))
+        return events
+
+    def read(self) -> list[str] | None:
+        """Returns changed paths, or None if events were lost."""
+        events = self.read_events()
+        return None if events is None else [path for path, _ in events]
@@ -1,57 +1,111 @@
 import logging
+import logging.handlers
+import atexit
+import copy
 import datetime
-import inspect
+import queue
+import sys
 from os.path import basename
 
 
 __logger = None
 
+#  Frames between a caller of 'info()' and friends and TrLogging.log()
+_CALLER_DEPTH = 4
+_RAW_ATTR = "tr_raw"
+
+
+class _Msg(object):
+    """Log message, formatted only for records that pass the level check."""
+    __slots__ = ("_fmt", "_args")
+
+    def __init__(self, fmt, args: tuple) -> None:
+        self._fmt = fmt
+        self._args = args
+
+    def __str__(self) -> str:
+        if self._args:
+            return str(self._fmt).format(*self._args)
+        return str(self._fmt)
+
+
+class _TrFormatter(logging.Formatter):
+    def __init__(self) -> None:
+        super().__init__('%(levelname).1s %(caller)s: %(message)s')
+
+    def format(self, record: logging.LogRecord) -> str:
+        if getattr(record, _RAW_ATTR, False):
+            return record.getMessage()
+        return super().format(record)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        #  The message is formatted here, on the calling thread, as its arguments may change before
+        #  the listener thread gets to it. The rest of the formatting is left for the listener.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
 
 class TrLogging(object):
     def __init__(self, log_file: str, log_level: int) -> None:
         self._logger = logging.getLogger()
-        self._raw_formatter = logging.Formatter('%(message)s')
-        self._default_formatter = logging.Formatter('%(levelname).1s %(message)s')
         self._file_handler = logging.FileHandler(log_file, encoding='utf-8')
-        self._file_handler.setFormatter(self._default_formatter)
+        self._file_handler.setFormatter(_TrFormatter())
         self._file_handler.setLevel(log_level)
-        self._logger.addHandler(self._file_handler)
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._listener = logging.handlers.QueueListener(self._queue, self._file_handler)
+        self._listener.start()
+        self._logger.addHandler(_QueueHandler(self._queue))
         self._logger.setLevel(log_level)
+        self._call_sites: dict[tuple, str] = {}
         self.raw_format = False
+        atexit.register(self.close)
+
+    def flush(self) -> None:
+        """Write all queued records. Logging can still be used afterwards."""
+        self._listener.stop()
+        self._file_handler.flush()
+        self._listener.start()
+
+    def close(self) -> None:
+        """Write all queued records and stop the listener thread, at exit. Threads can't be
+        started at interpreter shutdown, so the listener isn't restarted."""
+        self._listener.stop()
+        self._file_handler.close()
 
     def set_raw_format(self) -> None:
         self.raw_format = True
-        self._file_handler.setFormatter(self._raw_formatter)
 
     def set_default_format(self) -> None:
         self.raw_format = False
-        self._file_handler.setFormatter(self._default_formatter)
 
     def is_enabled_for(self, level: int) -> bool:
         return self._logger.isEnabledFor(level)
 
-    @staticmethod
-    def _frame_str() -> str:
-        frame = inspect.stack()[4]
-        return f"[{basename(frame.filename)}:{frame.lineno}] {frame.function}".ljust(38, '.')
-
-    def log(self, verbosity: int, msg_args) -> None:
+    def _caller_str(self) -> str:
+        frame = sys._getframe(_CALLER_DEPTH)
+        key = (frame.f_code, frame.f_lineno)
+        caller = self._call_sites.get(key)
+        if caller is None:
+            code = frame.f_code
+            caller = f"[{basename(code.co_filename)}:{frame.f_lineno}] {code.co_name}".ljust(
+                38, '.')
+            self._call_sites[key] = caller
+        return caller
+
+    def log(self, verbosity: int, msg_args, raw: bool = False) -> None:
         if not self._logger.isEnabledFor(verbosity):
             return
-        if isinstance(msg_args, tuple) and len(msg_args) == 1:
-            msg_args = str(msg_args[0])
-        if isinstance(msg_args, str):
-            if self.raw_format:
-                self._logger.log(verbosity, msg_args)
-            else:
-                self._logger.log(verbosity, f"{self._frame_str()}: {msg_args}")
-            return
-        assert type(msg_args) is tuple
-        if self.raw_format:
-            self._logger.log(verbosity, msg_args[0].format(*msg_args[1:]))
+        raw = raw or self.raw_format
+        if isinstance(msg_args, tuple):
+            msg = _Msg(msg_args[0], msg_args[1:])
         else:
-            self._logger.log(
-                verbosity, ("{}: " + msg_args[0]).format(self._frame_str(), *msg_args[1:]))
+            msg = _Msg(msg_args, ())
+        extra = {_RAW_ATTR: True} if raw else {"caller": self._caller_str()}
+        self._logger.log(verbosity, msg, extra=extra)
 
 
 def start_raw_logging() -> None:
@@ -72,19 +126,15 @@ def raw_msg(msg) -> None:
     global __logger
     if __logger is None:
         return
-    __logger.set_raw_format()
-    __logger.log(logging.INFO, msg)
-    __logger.set_default_format()
+    __logger.log(logging.INFO, msg, raw=True)
 
 
 def blank(count=1) -> None:
     global __logger
     if __logger is None:
         return
-    __logger.set_raw_format()
     for _ in range(0, count):
-        __logger.log(logging.INFO, "")
-    __logger.set_default_format()
+        __logger.log(logging.INFO, "", raw=True)
 
 
 def _process_msg_arr(verbosity: int, msg_args: tuple) -> None:
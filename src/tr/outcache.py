@@ -0,0 +1,244 @@
+from tr.logTools import info, verbose, warn
+from tr.cache import cache_dir, write_atomic
+from tr.uptodate import file_hash
+import os
+import json
+import time
+import shutil
+import tempfile
+
+#  Unreferenced objects younger than this might belong to an entry that is being stored
+_PRUNE_GRACE_SECS = 600
+
+
+class OutputCacheBackend(object):
+    """Interface of output cache storage backends."""
+
+    def restore(self, key: str, root: str) -> list[str] | None:
+        """Restore the outputs stored for 'key' under 'root'. Returns restored paths or None."""
+        raise NotImplementedError
+
+    def store(self, key: str, root: str, paths: list[str]) -> None:
+        """Store the files in 'paths' (relative to 'root') for 'key'."""
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        raise NotImplementedError
+
+    def prune(self, max_size: int, grace: int = _PRUNE_GRACE_SECS) -> tuple[int, int]:
+        """Evict least recently used entries until the cache fits in 'max_size' bytes.
+
+        Returns the number of removed entries and bytes."""
+        raise NotImplementedError
+
+
+class LocalOutputCache(OutputCacheBackend):
+    """Output cache in a local (or shared) directory.
+
+    File contents are stored once under 'objects', by their hash. Every entry has a manifest
+    under 'entries', whose modification time is its last use time. All writes are done to
+    temporary files which are then renamed, so several 'task' processes can share a cache.
+    """
+
+    def __init__(self, path: str, max_size: int) -> None:
+        self.path = path
+        self.max_size = max_size
+        self._objects_dir = os.path.join(path, "objects")
+        self._entries_dir = os.path.join(path, "entries")
+
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self._objects_dir, digest[:2], digest)
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self._entries_dir, f"{key}.json")
+
+    def _load_entry(self, path: str) -> dict | None:
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _check_rel_path(rel_path: str) -> None:
+        #  The cache might be shared, entries must not write outside of the task's directory
+        if not isinstance(rel_path, str) or os.path.isabs(rel_path) or \
+                os.pardir in rel_path.split(os.sep):
+            raise ValueError(f"Bad output path '{rel_path}'")
+
+    def _restore_files(self, key: str, entry: dict, root: str) -> list[str] | None:
+        files = entry["files"]
+        for rel_path, digest, _ in files:
+            self._check_rel_path(rel_path)
+            if not os.path.isfile(self._object_path(digest)):
+                info("Output cache entry '{}' is incomplete", key)
+                return None
+        for rel_path, digest, mode in files:
+            dest = os.path.join(root, rel_path)
+            verbose("Restoring '{}' from output cache", dest)
+            dest_dir = os.path.dirname(dest)
+            os.makedirs(dest_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=dest_dir, prefix=".tr-restore-")
+            os.close(fd)
+            try:
+                shutil.copyfile(self._object_path(digest), tmp_path)
+                os.chmod(tmp_path, mode)
+                os.replace(tmp_path, dest)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        return [f[0] for f in files]
+
+    def restore(self, key: str, root: str) -> list[str] | None:
+        entry_path = self._entry_path(key)
+        entry = self._load_entry(entry_path)
+        if entry is None:
+            info("Output cache miss for '{}'", key)
+            return None
+        try:
+            restored = self._restore_files(key, entry, root)
+        except (OSError, KeyError, ValueError, TypeError) as e:
+            #  E.g. objects pruned concurrently or a malformed entry, the task just runs
+            warn("Failed to restore outputs from cache entry '{}' - {}", key, e)
+            return None
+        if restored is None:
+            return None
+        try:
+            os.utime(entry_path)
+        except OSError:
+            pass
+        return restored
+
+    def _store_object(self, src: str) -> str:
+        digest = file_hash(src)
+        obj_path = self._object_path(digest)
+        if os.path.exists(obj_path):
+            os.utime(obj_path)
+            return digest
+        obj_dir = os.path.dirname(obj_path)
+        os.makedirs(obj_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=obj_dir, prefix=".tmp-")
+        os.close(fd)
+        try:
+            shutil.copyfile(src, tmp_path)
+            os.replace(tmp_path, obj_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return digest
+
+    def store(self, key: str, root: str, paths: list[str]) -> None:
+        files = []
+        size = 0
+        for rel_path in paths:
+            full_path = os.path.join(root, rel_path)
+            if os.path.isdir(full_path):
+                for dir_path, _, file_names in os.walk(full_path):
+                    for file_name in file_names:
+                        file_path = os.path.join(dir_path, file_name)
+                        files.append(os.path.relpath(file_path, root))
+            elif os.path.isfile(full_path):
+                files.append(rel_path)
+        entry_files = []
+        for rel_path in sorted(set(files)):
+            full_path = os.path.join(root, rel_path)
+            st = os.stat(full_path)
+            entry_files.append([rel_path, self._store_object(full_path), st.st_mode & 0o7777])
+            size += st.st_size
+        data = {"files": entry_files, "size": size, "created": time.time()}
+        write_atomic(self._entry_path(key), json.dumps(data).encode())
+        info("Stored {} output files ({} bytes) for '{}'", len(entry_files), size, key)
+        self.prune(self.max_size)
+
+    def _entries(self) -> list[tuple[float, str, dict]]:
+        entries = []
+        try:
+            it = os.scandir(self._entries_dir)
+        except FileNotFoundError:
+            return []
+        with it:
+            for e in it:
+                if not e.name.endswith(".json"):
+                    continue
+                entry = self._load_entry(e.path)
+                if entry is None:
+                    continue
+                try:
+                    entries.append((e.stat().st_mtime, e.path, entry))
+                except FileNotFoundError:
+                    pass
+        return sorted(entries, key=lambda e: e[0])
+
+    def _objects(self) -> dict[str, os.stat_result]:
+        objects = {}
+        if not os.path.isdir(self._objects_dir):
+            return objects
+        for sub_dir in os.scandir(self._objects_dir):
+            if not sub_dir.is_dir():
+                continue
+            for e in os.scandir(sub_dir.path):
+                if e.name.startswith("."):
+                    continue
+                try:
+                    objects[e.name] = e.stat()
+                except FileNotFoundError:
+                    pass
+        return objects
+
+    def stats(self) -> dict:
+        objects = self._objects()
+        return {
+            "path": self.path,
+            "entries": len(self._entries()),
+            "objects": len(objects),
+            "size": sum(st.st_size for st in objects.values()),
+            "max_size": self.max_size,
+        }
+
+    def prune(self, max_size: int, grace: int = _PRUNE_GRACE_SECS) -> tuple[int, int]:
+        entries = self._entries()
+        objects = self._objects()
+
+        def _entry_objects(entry: dict) -> set[str]:
+            return {f[1] for f in entry["files"]}
+
+        referenced: dict[str, int] = {}
+        for _, _, entry in entries:
+            for digest in _entry_objects(entry):
+                referenced[digest] = referenced.get(digest, 0) + 1
+        size = sum(objects[d].st_size for d in referenced if d in objects)
+        removed_entries = 0
+        #  Oldest first
+        for _, path, entry in entries:
+            if size <= max_size:
+                break
+            verbose("Evicting output cache entry '{}'", path)
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                continue
+            removed_entries += 1
+            for digest in _entry_objects(entry):
+                referenced[digest] -= 1
+                if referenced[digest] == 0 and digest in objects:
+                    size -= objects[digest].st_size
+
+        removed_bytes = 0
+        now = time.time()
+        for digest, st in objects.items():
+            if referenced.get(digest, 0) > 0 or now - st.st_mtime < grace:
+                continue
+            try:
+                os.unlink(self._object_path(digest))
+                removed_bytes += st.st_size
+            except FileNotFoundError:
+                pass
+        if removed_entries or removed_bytes:
+            info("Pruned {} output cache entries, {} bytes", removed_entries, removed_bytes)
+        return removed_entries, removed_bytes
+
+
+def output_cache_backend(path: str | None, max_size_mb: int) -> OutputCacheBackend:
+    if not path:
+        path = os.path.join(cache_dir(), "outputs")
+    return LocalOutputCache(path, max_size_mb * 1024 * 1024)
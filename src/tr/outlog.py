@@ -0,0 +1,219 @@
+from tr.logTools import info, verbose, warn_and_print
+from tr.common import TaskException
+import os
+import zlib
+import errno
+import threading
+import contextlib
+
+#  Bytes copied at a time. Pipes hold 64KB by default, larger chunks just mean fewer calls
+_CHUNK = 1 << 20
+#  Errors of splice() and sendfile() with descriptors they don't support
+_UNSUPPORTED_ERRNOS = {errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.EXDEV}
+_HAVE_SPLICE = hasattr(os, "splice") and hasattr(os, "sendfile")
+
+
+class LogFile(object):
+    """A command's output stream log. Once it grows beyond 'max_bytes' (if set), it's rotated:
+    'name.log' is renamed 'name.log.1', 'name.log.1' is renamed 'name.log.2' and so on, keeping
+    up to 'keep' old logs. Logs of earlier runs are rotated the same way.
+
+    With 'gzip', the log is compressed as it's written (and 'max_bytes' is of the compressed
+    size), and its files are named 'name.log.gz', 'name.log.1.gz' and so on.
+    """
+
+    def __init__(self, path: str, max_bytes: int, keep: int, gzip: bool) -> None:
+        self._base = path
+        self.max_bytes = max_bytes
+        self.keep = keep
+        self.gzip = gzip
+        self.fd = -1
+        self.size = 0
+        self._compressor = None
+        self._open()
+
+    def _path(self, i: int) -> str:
+        return self._base + (f".{i}" if i else "") + (".gz" if self.gzip else "")
+
+    def _open(self) -> None:
+        path = self._path(0)
+        try:
+            #  Whatever is there is the log of an earlier run, or the part before this rotation
+            for i in range(self.keep, 0, -1):
+                with contextlib.suppress(FileNotFoundError):
+                    os.replace(self._path(i - 1), self._path(i))
+            #  Readable too, output is sent to TR's descriptors from the log
+            self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, 0o644)
+        except OSError as e:
+            raise TaskException(f"Error opening output log '{path}' - {e}")
+        self.size = 0
+        if self.gzip:
+            #  Fastest level, to keep up with verbose commands. wbits=31 writes a gzip header
+            self._compressor = zlib.compressobj(1, wbits=31)
+
+    def _finish(self) -> None:
+        if self._compressor:
+            self._write_all(self._compressor.flush())
+            self._compressor = None
+        os.close(self.fd)
+        self.fd = -1
+
+    def _write_all(self, data: bytes) -> None:
+        view = memoryview(data)
+        while view:
+            n = os.write(self.fd, view)
+            view = view[n:]
+            self.size += n
+
+    def room(self) -> int:
+        """Bytes that can be written before the log is rotated"""
+        return max(self.max_bytes - self.size, 1) if self.max_bytes else _CHUNK
+
+    def rotate_if_full(self) -> None:
+        if self.max_bytes and self.size >= self.max_bytes:
+            verbose("Rotating output log '{}'", self._path(0))
+            self._finish()
+            self._open()
+
+    def write(self, data: bytes) -> None:
+        if self._compressor:
+            self._write_all(self._compressor.compress(data))
+            self.rotate_if_full()
+            return
+        if not self.max_bytes:
+            self._write_all(data)
+            return
+        while data:
+            room = self.max_bytes - self.size
+            self._write_all(data[:room])
+            data = data[room:]
+            self.rotate_if_full()
+
+    def splice_from(self, pipe_fd: int, count: int) -> int:
+        """Move up to 'count' bytes from 'pipe_fd' to the log, without copying them to user
+        space. Returns the number of bytes moved, 0 at end of input."""
+        n = os.splice(pipe_fd, self.fd, count)
+        self.size += n
+        return n
+
+    def close(self) -> None:
+        if self.fd >= 0:
+            self._finish()
+
+
+def _write_out(out_fd: int, data) -> bool:
+    """Write all of 'data' to out_fd. Returns False if out_fd can't be written anymore."""
+    try:
+        view = memoryview(data)
+        while view:
+            n = os.write(out_fd, view)
+            view = view[n:]
+    except OSError as e:
+        info("Stopped copying command output - {}", e)
+        return False
+    return True
+
+
+def _sendfile_out(out_fd: int, log: LogFile, offset: int, count: int) -> bool:
+    """Like _write_out(), of a part of the log that was just written"""
+    while count > 0:
+        try:
+            n = os.sendfile(out_fd, log.fd, offset, count)
+        except OSError as e:
+            if e.errno in _UNSUPPORTED_ERRNOS:
+                raise
+            info("Stopped copying command output - {}", e)
+            return False
+        if n == 0:
+            return False
+        offset += n
+        count -= n
+    return True
+
+
+def _tee(pipe_fd: int, out_fd: int, log: LogFile) -> None:
+    #  On Linux, output is spliced into the log file and sent from the (cached) file to out_fd,
+    #  so it's never copied to and from user space
+    splice = sendfile = _HAVE_SPLICE and not log.gzip
+    out_ok = True
+    while True:
+        if not splice:
+            data = os.read(pipe_fd, _CHUNK)
+            if not data:
+                break
+            log.write(data)
+            if out_ok:
+                out_ok = _write_out(out_fd, data)
+            continue
+
+        offset = log.size
+        try:
+            n = log.splice_from(pipe_fd, min(log.room(), _CHUNK))
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED_ERRNOS:
+                raise
+            info("Can't splice command output - {}", e)
+            splice = False
+            continue
+        if n == 0:
+            break
+        if out_ok and sendfile:
+            try:
+                out_ok = _sendfile_out(out_fd, log, offset, n)
+            except OSError as e:
+                info("Can't send command output with sendfile() - {}", e)
+                sendfile = False
+        if out_ok and not sendfile:
+            out_ok = _write_out(out_fd, os.pread(log.fd, n, offset))
+        log.rotate_if_full()
+
+
+class OutputTee(object):
+    """Copies a command's stdout and stderr pipes to TR's own and to log files, from threads
+    of its own, until the command (and whatever inherited its pipes) is done with them."""
+
+    def __init__(self, stdout, stderr, logs: tuple[LogFile, LogFile]) -> None:
+        self._threads = []
+        for pipe, out_fd, log in ((stdout, 1, logs[0]), (stderr, 2, logs[1])):
+            t = threading.Thread(target=self._run, args=(pipe, out_fd, log), daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    @staticmethod
+    def _run(pipe, out_fd: int, log: LogFile) -> None:
+        try:
+            _tee(pipe.fileno(), out_fd, log)
+        except (OSError, TaskException) as e:
+            warn_and_print(f"Failed writing output log - {e}")
+            #  Keep the command from blocking on a full pipe
+            out_ok = True
+            with contextlib.suppress(OSError):
+                while True:
+                    data = os.read(pipe.fileno(), _CHUNK)
+                    if not data:
+                        break
+                    out_ok = out_ok and _write_out(out_fd, data)
+        finally:
+            pipe.close()
+            with contextlib.suppress(OSError):
+                log.close()
+
+    def join(self) -> None:
+        for t in self._threads:
+            t.join()
+
+
+def open_logs(directory: str, name: str, max_bytes: int, keep: int,
+              gzip: bool) -> tuple[LogFile, LogFile]:
+    """stdout and stderr logs, 'name.stdout.log' and 'name.stderr.log' in 'directory'"""
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError as e:
+        raise TaskException(f"Error creating output log directory '{directory}' - {e}")
+    stdout_log = LogFile(os.path.join(directory, f"{name}.stdout.log"), max_bytes, keep, gzip)
+    try:
+        stderr_log = LogFile(os.path.join(directory, f"{name}.stderr.log"), max_bytes, keep, gzip)
+    except TaskException:
+        stdout_log.close()
+        raise
+    return stdout_log, stderr_log
@@ -0,0 +1,185 @@
+from tr.Task import Task, cancel_commands
+from tr.config import Config
+from tr.common import TaskException
+from tr.logTools import info, error_and_print
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+import os
+import time
+import signal
+
+#  Seconds commands get to stop once interrupted, before they are killed
+_INTERRUPT_GRACE_SECS = 5.0
+
+
+class _Node(object):
+    def __init__(self, name: str, task: Task) -> None:
+        self.name = name
+        self.task = task
+        self.deps: list[_Node] = []
+        self.dependents: list[_Node] = []
+        self.pending = 0
+        self.order = 0
+        self.rc: int | None = None
+        self.skipped = False
+        self.duration: float | None = None
+
+
+class TaskGraph(object):
+    """Dependency graph ('depends_on') of one or more tasks, with each task appearing once."""
+
+    def __init__(self, config: Config, roots: list[Task]) -> None:
+        self.config = config
+        self.nodes: dict[str, _Node] = {}
+        self.roots: list[_Node] = []
+        #  Variants of matrix tasks, by the matrix task name
+        self._matrix_deps: dict[str, list[_Node]] = {}
+        for task in roots:
+            node = self.nodes.get(task.full_name)
+            if node is None:
+                node = self.nodes[task.full_name] = _Node(task.full_name, task)
+                if task.variant_of:
+                    self._matrix_deps.setdefault(task.variant_of, []).append(node)
+            self.roots.append(node)
+        self._add_deps()
+        self._sort()
+
+    def _add_deps(self) -> None:
+        stack = list(self.nodes.values())
+        while stack:
+            node = stack.pop()
+            for dep_name in node.task.depends_on:
+                name = self.config.names.full_name(dep_name)
+                deps = self._matrix_deps.get(name)
+                if deps is None:
+                    dep = self.nodes.get(name)
+                    deps = [dep] if dep else []
+                if not deps:
+                    info("Adding dependency '{}' of '{}'", name, node.name)
+                    dep_task = Task(name, self.config)
+                    #  Depending on a matrix task is depending on all of its variants
+                    for task in dep_task.matrix_variants() if dep_task.matrix else [dep_task]:
+                        dep = self.nodes[task.full_name] = _Node(task.full_name, task)
+                        dep.task.expand()
+                        deps.append(dep)
+                    stack += deps
+                    if dep_task.matrix:
+                        self._matrix_deps[name] = deps
+                for dep in deps:
+                    if dep in node.deps:
+                        continue
+                    node.deps.append(dep)
+                    dep.dependents.append(node)
+        for node in self.nodes.values():
+            node.pending = len(node.deps)
+
+    def _sort(self) -> None:
+        """Order nodes depth first (dependencies first), and reject dependency loops."""
+        order = 0
+        state: dict[str, int] = {}  # 1 - in current path, 2 - done
+        for root in self.roots:
+            if root.name in state:
+                continue
+            path = [root.name]
+            stack = [(root, iter(root.deps))]
+            state[root.name] = 1
+            while stack:
+                node, deps = stack[-1]
+                dep = next(deps, None)
+                if dep is None:
+                    stack.pop()
+                    path.pop()
+                    state[node.name] = 2
+                    node.order = order
+                    order += 1
+                    continue
+                dep_state = state.get(dep.name)
+                if dep_state == 1:
+                    loop = path[path.index(dep.name):] + [dep.name]
+                    raise TaskException("Dependency loop detected - {}".format(" -> ".join(loop)))
+                if dep_state == 2:
+                    continue
+                state[dep.name] = 1
+                path.append(dep.name)
+                stack.append((dep, iter(dep.deps)))
+
+    def _skip_dependents(self, node: _Node) -> None:
+        stack = list(node.dependents)
+        while stack:
+            dependent = stack.pop()
+            if dependent.rc is not None:
+                continue
+            info("Task '{}' won't run, dependency '{}' failed", dependent.name, node.name)
+            print(f"Skipping task '{dependent.name}' - dependency '{node.name}' failed")
+            dependent.rc = node.rc
+            dependent.skipped = True
+            stack += dependent.dependents
+
+    @staticmethod
+    def _run_node(node: _Node) -> int:
+        info("Running task '{}'", node.name)
+        start = time.monotonic()
+        try:
+            return node.task.run()
+        finally:
+            node.duration = time.monotonic() - start
+
+    def results(self) -> list[tuple[str, str, float | None]]:
+        """(name, result, duration) of every task, in execution order."""
+        results = []
+        for node in sorted(self.nodes.values(), key=lambda n: n.order):
+            if node.skipped:
+                result = "Skipped"
+            elif node.rc is None:
+                result = "Not run"
+            elif node.rc == 0:
+                result = "OK"
+            else:
+                result = f"Failed ({node.rc})"
+            results.append((node.name, result, node.duration))
+        return results
+
+    def run(self, max_jobs: int | None = None, keep_going: bool = False) -> int:
+        max_jobs = max_jobs if max_jobs else (os.cpu_count() or 1)
+        info("Running {} tasks, max_jobs={}, keep_going={}", len(self.nodes), max_jobs, keep_going)
+        ready = sorted((n for n in self.nodes.values() if n.pending == 0), key=lambda n: n.order)
+        running: dict[Future, _Node] = {}
+        rc = 0
+        stopped = False
+        executor = ThreadPoolExecutor(max_workers=max_jobs)
+        try:
+            while ready or running:
+                while ready and not stopped and len(running) < max_jobs:
+                    node = ready.pop(0)
+                    running[executor.submit(TaskGraph._run_node, node)] = node
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for f in sorted(done, key=lambda f: running[f].order):
+                    node = running.pop(f)
+                    try:
+                        node_rc = f.result()
+                    except TaskException as e:
+                        error_and_print(f"Task '{node.name}' - {e}")
+                        node_rc = 255
+                    node.rc = node_rc
+                    if node_rc == 0:
+                        for dependent in node.dependents:
+                            dependent.pending -= 1
+                            if dependent.pending == 0 and dependent.rc is None:
+                                ready.append(dependent)
+                        ready.sort(key=lambda n: n.order)
+                        continue
+                    info("Task '{}' had failed rc={}", node.name, node_rc)
+                    if rc == 0:
+                        rc = node_rc
+                    self._skip_dependents(node)
+                    if not keep_going:
+                        stopped = True
+        except KeyboardInterrupt:
+            #  Tasks run on other threads, so their commands are stopped here, like the ones of a
+            #  task running on this thread, before waiting for the threads
+            cancel_commands(_INTERRUPT_GRACE_SECS, signal.SIGINT)
+            raise TaskException("User interrupt")
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+        return rc
@@ -0,0 +1,70 @@
+from tr.logTools import info
+from tr.spawn import Spawner, SpawnedProcess
+import os
+import shlex
+import secrets
+import contextlib
+
+#  Descriptors of the shell's script and of the commands' status reports, in the shell. Kept
+#  below 10, as some shells (e.g. dash) don't support higher numbers in redirections.
+_SCRIPT_FD = 8
+_STATUS_FD = 9
+
+
+class ShellSession(object):
+    """A shell running a task's commands one after the other, so its state (working directory,
+    variables, functions...) is kept between them.
+
+    The shell reads its script from a pipe rather than its stdin, which is left for the
+    commands. Every command is sent to it as an 'eval' (so a bad command doesn't break the
+    script), followed by a report of its status, with a random sentinel, to another pipe.
+    """
+
+    def __init__(self, spawner: Spawner, shell_path: str, cwd: str | None,
+                 pipes: bool = False) -> None:
+        script_r, script_w = os.pipe()
+        status_r, status_w = os.pipe()
+        try:
+            self.p: SpawnedProcess = spawner.spawn(
+                [shell_path, f"/dev/fd/{_SCRIPT_FD}"], False, None, pipes=pipes,
+                fds={_SCRIPT_FD: script_r, _STATUS_FD: status_w})
+        except BaseException:
+            os.close(script_w)
+            os.close(status_r)
+            raise
+        finally:
+            os.close(script_r)
+            os.close(status_w)
+        info("Shell session pid={} started", self.p.pid)
+        self._script = open(script_w, "wb")
+        self._status = open(status_r, "rb")
+        self._sentinel = secrets.token_hex(8).encode()
+        #  The shell reads its script from a descriptor of its own
+        self._send(f"exec {_SCRIPT_FD}<&-")
+        if cwd:
+            self._send(f"cd -- {shlex.quote(cwd)} || exit 1")
+
+    def _send(self, line: str) -> bool:
+        try:
+            self._script.write(line.encode() + b"\n")
+            self._script.flush()
+        except BrokenPipeError:
+            return False
+        return True
+
+    def run(self, cmd: str) -> int | None:
+        """Run a command, returning its return code, or None if the shell exited."""
+        if not self._send(f"eval {shlex.quote(cmd)} {_STATUS_FD}>&-; "
+                          f"printf '{self._sentinel.decode()} %d\\n' \"$?\" >&{_STATUS_FD}"):
+            return None
+        for line in self._status:
+            fields = line.split()
+            if len(fields) == 2 and fields[0] == self._sentinel:
+                return int(fields[1])
+        return None
+
+    def close(self) -> None:
+        """End the script. The shell exits once it's done with the current command."""
+        with contextlib.suppress(BrokenPipeError):
+            self._script.close()
+        self._status.close()
@@ -0,0 +1,151 @@
+from tr.logTools import info
+from types import MappingProxyType
+from typing import Mapping, Union
+import os
+import errno
+import fcntl
+import signal
+import threading
+import subprocess
+
+#  Signals python ignores, which subprocess restores to default in new processes
+_RESTORED_SIGNALS = {getattr(signal, s) for s in ("SIGPIPE", "SIGXFSZ") if hasattr(signal, s)}
+
+
+def command_env(inherit_os_env: bool, env: dict[str, str]) -> Mapping[str, str]:
+    """The environment of a task's commands, built once for all of them. os.environ is never
+    modified, as tasks might run concurrently."""
+    if not inherit_os_env:
+        return MappingProxyType(dict(env))
+    full_env = dict(os.environ)
+    full_env.update(env)
+    return MappingProxyType(full_env)
+
+
+class SpawnedProcess(object):
+    """The parts of subprocess.Popen's interface used for commands, of a process started by
+    Spawner.spawn()"""
+
+    def __init__(self, pid: int, stdout=None, stderr=None) -> None:
+        self.pid = pid
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode: int | None = None
+        self._lock = threading.Lock()
+
+    def poll(self) -> int | None:
+        #  Like Popen, don't block if another thread is waiting for the process
+        if self.returncode is not None or not self._lock.acquire(blocking=False):
+            return self.returncode
+        try:
+            if self.returncode is None:
+                pid, status = os.waitpid(self.pid, os.WNOHANG)
+                if pid == self.pid:
+                    self.returncode = os.waitstatus_to_exitcode(status)
+        except ChildProcessError:
+            #  Reaped elsewhere (e.g. by a stats probe), which set the return code
+            pass
+        finally:
+            self._lock.release()
+        return self.returncode
+
+    def wait(self) -> int:
+        with self._lock:
+            if self.returncode is None:
+                _, status = os.waitpid(self.pid, 0)
+                self.returncode = os.waitstatus_to_exitcode(status)
+        return self.returncode
+
+
+Process = Union[subprocess.Popen, SpawnedProcess]
+
+
+def _same_dir(cwd: str | None) -> bool:
+    if not cwd:
+        return True
+    try:
+        return os.path.samefile(cwd, os.getcwd())
+    except OSError:
+        return False
+
+
+class Spawner(object):
+    """Starts a task's commands with os.posix_spawn(), which is vfork based and doesn't close
+    inherited file descriptors (python opens them all close-on-exec), with the environment and
+    the programs' paths prepared once. posix_spawn() can't change the working directory, so
+    it's only 'enabled' for commands running in TR's own.
+
+    Commands are started the way subprocess.Popen(cmd, shell, executable, env,
+    process_group=0) starts them.
+    """
+
+    def __init__(self, env: Mapping[str, str], cwd: str | None) -> None:
+        self.env = env
+        self.enabled = hasattr(os, "posix_spawn") and _same_dir(cwd)
+        self._exec_path = os.get_exec_path(env)  # type: ignore
+        self._programs: dict[str, str] = {}
+        info("Fast command spawning is {}", "enabled" if self.enabled else "disabled")
+
+    def _find_program(self, program: str) -> str:
+        path = self._programs.get(program)
+        if path is not None:
+            return path
+        for d in self._exec_path:
+            path = os.path.join(d, program)
+            if os.path.isfile(path) and os.access(path, os.X_OK):
+                self._programs[program] = path
+                return path
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), program)
+
+    def _spawn(self, path: str, argv: list[str], file_actions: list) -> int:
+        return os.posix_spawn(path, argv, self.env, file_actions=file_actions, setpgroup=0,
+                              setsigdef=_RESTORED_SIGNALS)
+
+    def spawn(self, cmd: list[str], shell: bool, executable: str | None, pipes: bool = False,
+              fds: dict[int, int] | None = None, null_stdin: bool = False) -> SpawnedProcess:
+        """Start a command. 'pipes' sets its stdout and stderr to new pipes, 'null_stdin' sets
+        its stdin to /dev/null, and 'fds' passes it more descriptors, by their number (lower
+        than 10) in the new process."""
+        argv = list(cmd)
+        if shell:
+            argv = ["/bin/sh", "-c"] + argv
+            if executable:
+                argv[0] = executable
+        program = executable or argv[0]
+        file_actions = []
+        read_fds: list[int] = []
+        #  The new process's ends, closed in TR once it started
+        child_fds: list[int] = []
+        try:
+            for target, fd in (fds or {}).items():
+                #  Copies above the targets, so no source is overwritten before it's copied
+                high_fd = fcntl.fcntl(fd, fcntl.F_DUPFD_CLOEXEC, 10)
+                child_fds.append(high_fd)
+                file_actions.append((os.POSIX_SPAWN_DUP2, high_fd, target))
+            if null_stdin:
+                file_actions.append((os.POSIX_SPAWN_OPEN, 0, os.devnull, os.O_RDONLY, 0))
+            if pipes:
+                for target in (1, 2):
+                    r, w = os.pipe()
+                    read_fds.append(r)
+                    child_fds.append(w)
+                    file_actions.append((os.POSIX_SPAWN_DUP2, w, target))
+            if "/" in program:
+                pid = self._spawn(program, argv, file_actions)
+            else:
+                try:
+                    pid = self._spawn(self._find_program(program), argv, file_actions)
+                except FileNotFoundError:
+                    #  The program might have moved since it was found
+                    self._programs.pop(program, None)
+                    pid = self._spawn(self._find_program(program), argv, file_actions)
+        except BaseException:
+            for fd in read_fds:
+                os.close(fd)
+            raise
+        finally:
+            for fd in child_fds:
+                os.close(fd)
+        if not pipes:
+            return SpawnedProcess(pid)
+        return SpawnedProcess(pid, open(read_fds[0], "rb"), open(read_fds[1], "rb"))
@@ -0,0 +1,181 @@
+from tr.logTools import info, warn_and_print
+from tr.spawn import Process
+import os
+import sys
+import json
+import time
+import threading
+import subprocess
+
+__stats = None
+
+#  ru_maxrss is in kilobytes on Linux, but in bytes on macOS
+_MAXRSS_DIVIDER = 1024 if sys.platform == "darwin" else 1
+
+
+def container_cgroup_dir(tool: list[str], name: str) -> str | None:
+    """cgroup (v2) directory of a running container, if it can be found."""
+    try:
+        p = subprocess.run(tool + ["inspect", "-f", "{{.Id}}", name], stdout=subprocess.PIPE,
+                           stderr=subprocess.DEVNULL, text=True)
+    except OSError:
+        return None
+    cid = p.stdout.strip()
+    if p.returncode != 0 or not cid:
+        return None
+    uid = os.getuid()
+    for d in (f"/sys/fs/cgroup/system.slice/docker-{cid}.scope",
+              f"/sys/fs/cgroup/docker/{cid}",
+              f"/sys/fs/cgroup/machine.slice/libpod-{cid}.scope",
+              f"/sys/fs/cgroup/user.slice/user-{uid}.slice/user@{uid}.service/user.slice/"
+              f"libpod-{cid}.scope"):
+        if os.path.isfile(os.path.join(d, "cpu.stat")):
+            return d
+    info("cgroup of container '{}' wasn't found", name)
+    return None
+
+
+def _read_kv(path: str) -> dict[str, int]:
+    values = {}
+    with open(path, "r") as f:
+        for line in f:
+            k, _, v = line.partition(" ")
+            if v.strip().isdigit():
+                values[k] = int(v)
+    return values
+
+
+def _cgroup_usage(cgroup_dir: str) -> dict | None:
+    try:
+        cpu = _read_kv(os.path.join(cgroup_dir, "cpu.stat"))
+        reads = writes = 0
+        with open(os.path.join(cgroup_dir, "io.stat"), "r") as f:
+            for line in f:
+                for field in line.split()[1:]:
+                    k, _, v = field.partition("=")
+                    if k == "rios":
+                        reads += int(v)
+                    elif k == "wios":
+                        writes += int(v)
+        with open(os.path.join(cgroup_dir, "memory.peak"), "r") as f:
+            peak = int(f.read())
+    except (OSError, ValueError):
+        return None
+    return {"user": cpu.get("user_usec", 0) / 1e6, "sys": cpu.get("system_usec", 0) / 1e6,
+            "reads": reads, "writes": writes, "peak": peak}
+
+
+class CommandProbe(object):
+    """Measures a single command, from right before it's started until it's reaped."""
+
+    def __init__(self, stats: "Stats", task: str, cmd: str, cgroup_dir: str | None) -> None:
+        self._stats = stats
+        self._task = task
+        self._cmd = cmd
+        self._cgroup_dir = cgroup_dir
+        self._cgroup_start = _cgroup_usage(cgroup_dir) if cgroup_dir else None
+        self._start = time.monotonic()
+
+    def wait(self, p: Process) -> int:
+        """Reap 'p' (instead of p.wait()) and record its resources usage."""
+        try:
+            _, status, ru = os.wait4(p.pid, 0)
+        except ChildProcessError:
+            #  Already reaped elsewhere, so its resources usage is lost
+            rc = p.wait()
+            self._stats.add({
+                "task": self._task, "command": self._cmd, "pid": p.pid, "rc": rc,
+                "wall": time.monotonic() - self._start, "user": None, "sys": None,
+                "max_rss_kb": None, "in_blocks": None, "out_blocks": None, "source": None
+            })
+            return rc
+        wall = time.monotonic() - self._start
+        p.returncode = os.waitstatus_to_exitcode(status)
+        record = {
+            "task": self._task, "command": self._cmd, "pid": p.pid, "rc": p.returncode,
+            "wall": wall, "user": ru.ru_utime, "sys": ru.ru_stime,
+            "max_rss_kb": ru.ru_maxrss // _MAXRSS_DIVIDER, "in_blocks": ru.ru_inblock,
+            "out_blocks": ru.ru_oublock, "source": "rusage"
+        }
+        cgroup_end = _cgroup_usage(self._cgroup_dir) if self._cgroup_dir else None
+        if self._cgroup_start and cgroup_end:
+            #  Usage of the command inside the container rather than of the container tool.
+            #  Peak memory is the container's, since it was started.
+            start = self._cgroup_start
+            record.update({
+                "user": cgroup_end["user"] - start["user"], "sys": cgroup_end["sys"] - start["sys"],
+                "max_rss_kb": cgroup_end["peak"] // 1024,
+                "in_blocks": cgroup_end["reads"] - start["reads"],
+                "out_blocks": cgroup_end["writes"] - start["writes"], "source": "cgroup"
+            })
+        self._stats.add(record)
+        return p.returncode
+
+
+class Stats(object):
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.records: list[dict] = []
+        self._lock = threading.Lock()
+
+    def add(self, record: dict) -> None:
+        with self._lock:
+            self.records.append(record)
+
+    def print_summary(self) -> None:
+        if not self.records:
+            return
+        cmd_len = 40
+        print_fmt = f"{{:<{cmd_len}}}  {{:>6}}" + "  {:>9}" * 3 + "  {:>10}" + "  {:>9}" * 2
+        print()
+        print(print_fmt.format("Command", "RC", "Wall", "User", "Sys", "Max RSS", "In blks",
+                               "Out blks"))
+        print(print_fmt.format("-------", "--", "----", "----", "---", "-------", "-------",
+                               "--------"))
+        for r in self.records:
+            cmd = f"{r['task']}: {r['command']}"
+            if len(cmd) > cmd_len:
+                cmd = cmd[:cmd_len - 3] + "..."
+            if r["source"] is None:
+                print(print_fmt.format(cmd, r["rc"], f"{r['wall']:.2f}s", *["-"] * 5))
+                continue
+            print(print_fmt.format(cmd, r["rc"], f"{r['wall']:.2f}s", f"{r['user']:.2f}s",
+                                   f"{r['sys']:.2f}s", f"{r['max_rss_kb'] // 1024}MB",
+                                   r["in_blocks"], r["out_blocks"]))
+
+    def write(self) -> None:
+        with open(self.path, "w") as f:
+            json.dump({"commands": self.records}, f, indent=4)
+        info("Stats of {} commands written to '{}'", len(self.records), self.path)
+
+
+def init_stats(path: str) -> None:
+    global __stats
+    assert __stats is None
+    if not path:
+        return
+    __stats = Stats(path)
+
+
+def command_probe(task: str, cmd: str, cgroup_dir: str | None = None) -> CommandProbe | None:
+    """Returns a probe for a command about to be started, or None if stats are off."""
+    if __stats is None:
+        return None
+    return CommandProbe(__stats, task, cmd, cgroup_dir)
+
+
+def stats_enabled() -> bool:
+    return __stats is not None
+
+
+def finish_stats() -> None:
+    global __stats
+    if __stats is None:
+        return
+    stats = __stats
+    __stats = None
+    stats.print_summary()
+    try:
+        stats.write()
+    except OSError as e:
+        warn_and_print(f"Failed to write stats file '{stats.path}' - {e}")
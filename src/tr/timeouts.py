@@ -0,0 +1,148 @@
+from tr.logTools import info
+from tr.spawn import Process
+from typing import Callable
+import os
+import sys
+import signal
+import threading
+import contextlib
+
+#  Return code of a command that ended after it was sent the timeout signal (as in timeout(1))
+TIMEOUT_RC = 124
+#  Return code of a command that had to be killed once the grace period was over
+KILLED_RC = 128 + signal.SIGKILL
+
+#  Popen arguments to start a command in a process group of its own
+if sys.version_info >= (3, 11):
+    NEW_GROUP_KWARGS: dict = {"process_group": 0}
+else:
+    NEW_GROUP_KWARGS: dict = {"preexec_fn": os.setpgrp}
+
+
+def signal_group(p: Process, sig: int) -> None:
+    """Send 'sig' to every process in p's process group"""
+    try:
+        os.killpg(p.pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def _raise_interrupt(signum, frame) -> None:
+    raise KeyboardInterrupt()
+
+
+@contextlib.contextmanager
+def terminate_as_interrupt():
+    """Handle SIGTERM and SIGHUP like Ctrl-C (i.e. KeyboardInterrupt) while running commands.
+
+    Commands run in process groups of their own, so they'd be left running once TR is terminated.
+    Must be used on the main thread.
+    """
+    handlers = {sig: signal.signal(sig, _raise_interrupt)
+                for sig in (signal.SIGTERM, signal.SIGHUP)}
+    try:
+        yield
+    finally:
+        for sig, handler in handlers.items():
+            signal.signal(sig, handler)
+
+
+def _set_foreground(fd: int, pgid: int) -> None:
+    #  A background process changing the foreground group is sent SIGTTOU, unless it's blocked
+    mask = signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTTOU})
+    try:
+        os.tcsetpgrp(fd, pgid)
+    finally:
+        signal.pthread_sigmask(signal.SIG_SETMASK, mask)
+
+
+@contextlib.contextmanager
+def terminal_foreground(p: Process):
+    """Hand the terminal to p's process group while it runs, like shells do with jobs. Yields
+    True if the terminal was handed over.
+
+    Commands run in process groups of their own, so without it, commands reading the terminal
+    would be stopped and terminal signals (e.g. SIGINT on Ctrl-C) wouldn't reach them.
+    """
+    fd = -1
+    try:
+        fd = sys.stdin.fileno()
+        is_foreground = os.isatty(fd) and os.tcgetpgrp(fd) == os.getpgrp()
+    except (OSError, ValueError, AttributeError):
+        is_foreground = False
+    if fd < 0 or not is_foreground:
+        yield False
+        return
+    try:
+        _set_foreground(fd, p.pid)
+        #  The command might have been stopped reading the terminal before it was handed over
+        signal_group(p, signal.SIGCONT)
+    except OSError as e:
+        info("Failed to hand the terminal to the command - {}", e)
+        yield False
+        return
+    try:
+        yield True
+    finally:
+        with contextlib.suppress(OSError):
+            _set_foreground(fd, os.getpgrp())
+
+
+class CommandTimer(object):
+    """Sends 'sig' to a command's process group once 'seconds' pass, and SIGKILL once 'grace'
+    more seconds pass. 'on_signal', if set, is called with every signal sent (e.g. to signal the
+    command's container as well).
+    """
+
+    def __init__(self, p: Process, seconds: float, sig: int, grace: float,
+                 on_signal: Callable[[int], None] | None = None) -> None:
+        self.p = p
+        self.seconds = seconds
+        self.expired = False
+        self.killed = False
+        self._sig = sig
+        self._grace = grace
+        self._on_signal = on_signal
+        self._lock = threading.Lock()
+        self._done = False
+        self._timer = self._start_timer(seconds, self._expire)
+
+    @staticmethod
+    def _start_timer(seconds: float, func: Callable[[], None]) -> threading.Timer:
+        timer = threading.Timer(seconds, func)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    def _send(self, sig: int) -> None:
+        info("Sending signal {} to command pid={}", signal.Signals(sig).name, self.p.pid)
+        signal_group(self.p, sig)
+        if self._on_signal:
+            self._on_signal(sig)
+
+    def _expire(self) -> None:
+        with self._lock:
+            if self._done:
+                return
+            self.expired = True
+            self._send(self._sig)
+            if self._sig != signal.SIGKILL:
+                self._timer = self._start_timer(self._grace, self._kill)
+
+    def _kill(self) -> None:
+        with self._lock:
+            if self._done:
+                return
+            self.killed = True
+            self._send(signal.SIGKILL)
+
+    def finish(self, rc: int) -> int:
+        """Stop the timer once the command was reaped. Returns the command's return code."""
+        with self._lock:
+            self._done = True
+            self._timer.cancel()
+        if not self.expired:
+            return rc
+        #  Whatever is left of the command's processes
+        signal_group(self.p, signal.SIGKILL)
+        return KILLED_RC if self.killed or self._sig == signal.SIGKILL else TIMEOUT_RC
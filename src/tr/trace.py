@@ -0,0 +1,112 @@
+from tr.logTools import info, warn_and_print
+import os
+import json
+import time
+import threading
+
+__tracer = None
+
+
+class _NullSpan(object):
+    """Span returned when tracing is off. Shared, and does nothing."""
+    __slots__ = ()
+
+    def __enter__(self) -> "_NullSpan":
+        return self
+
+    def __exit__(self, *_) -> bool:
+        return False
+
+    def set(self, **_) -> None:
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    __slots__ = ("_tracer", "_name", "_args", "_start")
+
+    def __init__(self, tracer: "Tracer", name: str, args: dict) -> None:
+        self._tracer = tracer
+        self._name = name
+        self._args = args
+        self._start = 0
+
+    def __enter__(self) -> "_Span":
+        self._start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, *_) -> bool:
+        end = time.perf_counter_ns()
+        if exc_type is not None:
+            self._args["error"] = exc_type.__name__
+        self._tracer.add(self._name, self._start, end, self._args)
+        return False
+
+    def set(self, **args) -> None:
+        """Add arguments known only after the span started (e.g. pid, return code)."""
+        self._args.update(args)
+
+
+class Tracer(object):
+    """Collects complete ('X') events, written as a Chrome trace-event JSON file."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._origin = time.perf_counter_ns()
+        self._events: list[dict] = []
+        self._threads: dict[int, str] = {}
+        self._lock = threading.Lock()
+
+    def add(self, name: str, start: int, end: int, args: dict) -> None:
+        tid = threading.get_native_id()
+        event = {"name": name, "cat": "tr", "ph": "X", "pid": os.getpid(), "tid": tid,
+                 "ts": (start - self._origin) / 1000, "dur": (end - start) / 1000}
+        if args:
+            event["args"] = args
+        with self._lock:
+            self._events.append(event)
+            if tid not in self._threads:
+                self._threads[tid] = threading.current_thread().name
+
+    def write(self) -> None:
+        pid = os.getpid()
+        meta = [{"name": "process_name", "ph": "M", "pid": pid, "args": {"name": "task"}}]
+        meta += [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+                 for tid, name in self._threads.items()]
+        with open(self.path, "w") as f:
+            json.dump({"traceEvents": meta + self._events, "displayTimeUnit": "ms"}, f,
+                      default=str)
+        info("Trace with {} events written to '{}'", len(self._events), self.path)
+
+
+def init_tracing(path: str) -> None:
+    global __tracer
+    assert __tracer is None
+    if not path:
+        return
+    __tracer = Tracer(path)
+
+
+def tracing_enabled() -> bool:
+    return __tracer is not None
+
+
+def span(name: str, **args):
+    """Context manager timing a phase. Costs a single check when tracing is off."""
+    if __tracer is None:
+        return _NULL_SPAN
+    return _Span(__tracer, name, args)
+
+
+def finish_tracing() -> None:
+    global __tracer
+    if __tracer is None:
+        return
+    tracer = __tracer
+    __tracer = None
+    try:
+        tracer.write()
+    except OSError as e:
+        warn_and_print(f"Failed to write trace file '{tracer.path}' - {e}")
@@ -0,0 +1,102 @@
+from tr.logTools import info, verbose
+from tr.cache import write_atomic
+import os
+import glob
+import json
+import hashlib
+from urllib.parse import quote
+
+_STORE_DIR = ".taskrunner/fingerprints"
+_HASH_CHUNK = 1 << 20
+
+
+def _glob(patterns: list[str], root: str, files_only: bool) -> tuple[list[str], list[str]]:
+    """Returns matched paths, and patterns with no matches at all."""
+    paths = set()
+    missing = []
+    for pattern in patterns:
+        matched = glob.glob(pattern, root_dir=root, recursive=True)
+        if files_only:
+            matched = [p for p in matched if os.path.isfile(os.path.join(root, p))]
+        if not matched:
+            missing.append(pattern)
+        paths.update(matched)
+    return sorted(paths), missing
+
+
+def file_hash(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(_HASH_CHUNK):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class Fingerprint(object):
+    """Fingerprint of a task's inputs, stored under the task root after a successful run."""
+
+    def __init__(self, task_root: str, task_name: str, cwd: str, inputs: list[str],
+                 outputs: list[str], settings: dict) -> None:
+        self.store_path = os.path.join(task_root, _STORE_DIR, quote(task_name, safe="") + ".json")
+        self.cwd = cwd
+        self.inputs = inputs
+        self.outputs = outputs
+        self.settings = settings
+        self.files: dict[str, list] = {}
+        self.digest = ""
+
+    def _load_store(self) -> dict:
+        try:
+            with open(self.store_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def compute(self) -> None:
+        """Hash the inputs, reusing stored hashes of files whose size and mtime didn't change."""
+        stored_files = self._load_store().get("files", {})
+        paths, missing = _glob(self.inputs, self.cwd, files_only=True)
+        if missing:
+            info("Input patterns with no matches: {}", missing)
+        h = hashlib.sha256(json.dumps(self.settings, sort_keys=True).encode())
+        for path in paths:
+            full_path = os.path.join(self.cwd, path)
+            st = os.stat(full_path)
+            stored = stored_files.get(path)
+            if stored and stored[0] == st.st_size and stored[1] == st.st_mtime_ns:
+                digest = stored[2]
+            else:
+                verbose("Hashing input file '{}'", full_path)
+                digest = file_hash(full_path)
+            self.files[path] = [st.st_size, st.st_mtime_ns, digest]
+            h.update(f"{path}\0{digest}\0".encode())
+        self.digest = h.hexdigest()
+
+    def output_paths(self) -> tuple[list[str], list[str]]:
+        return _glob(self.outputs, self.cwd, files_only=False)
+
+    def up_to_date(self) -> bool:
+        stored = self._load_store()
+        if stored.get("digest") != self.digest:
+            info("Task inputs changed since last successful run")
+            return False
+        _, missing = self.output_paths()
+        if missing:
+            info("Missing task outputs: {}", missing)
+            return False
+        return True
+
+    def save(self) -> None:
+        data = {"digest": self.digest, "files": self.files}
+        try:
+            write_atomic(self.store_path, json.dumps(data).encode())
+        except OSError as e:
+            info("Failed to save fingerprint '{}' - {}", self.store_path, e)
+
+    def invalidate(self) -> None:
+        try:
+            os.unlink(self.store_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            info("Failed to remove fingerprint '{}' - {}", self.store_path, e)
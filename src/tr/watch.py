@@ -0,0 +1,264 @@
+from tr.config import Config
+from tr.common import TaskException, WatchPolicy
+from tr.logTools import info, verbose, error_and_print
+from tr.inotify import Inotify
+from tr.scheduler import TaskGraph
+from tr.Task import cancel_commands, reset_cancel
+from tr.actions import run_task, root_tasks
+from tr.timeouts import terminate_as_interrupt
+import os
+import re
+import sys
+import time
+import selectors
+import threading
+
+#  Ignored under the task root, on top of '--ignore' globs and the tasks' outputs
+_DFLT_IGNORES = [".git/**", ".taskrunner/**", "**/__pycache__/**", "**/*.swp", "**/*~"]
+_CANCEL_GRACE_SECS = 5.0
+_GLOB_CHARS = "*?["
+
+
+def _glob_re(pattern: str) -> re.Pattern:
+    """Regular expression matching paths the way glob.glob(pattern, recursive=True) does"""
+    out = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith("**/", i):
+            out.append("(?:.*/)?")
+            i += 3
+            continue
+        if pattern.startswith("**", i):
+            out.append(".*")
+            i += 2
+            continue
+        if c == "*":
+            out.append("[^/]*")
+        elif c == "?":
+            out.append("[^/]")
+        elif c == "[" and pattern.find("]", i + 2) > 0:
+            end = pattern.find("]", i + 2)
+            body = pattern[i + 1:end]
+            if body.startswith("!"):
+                body = "^" + body[1:]
+            out.append("[" + body.replace("\\", "\\\\") + "]")
+            i = end + 1
+            continue
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return re.compile("".join(out))
+
+
+def _glob_base(pattern: str) -> tuple[str, bool]:
+    """Directory of a (normalized, absolute) glob pattern's static part, and if matching paths
+    might be deeper than directly in it"""
+    parts = pattern.split("/")
+    static = 0
+    while static < len(parts) - 1 and not any(c in parts[static] for c in _GLOB_CHARS):
+        static += 1
+    rest = parts[static:]
+    return "/".join(parts[:static]) or "/", len(rest) > 1 or "**" in rest[0]
+
+
+class _Watcher(object):
+    def __init__(self, config: Config, inotify: Inotify) -> None:
+        self.config = config
+        self._inotify = inotify
+        args = config.args
+        self._debounce = max(args.debounce, 0) / 1000
+        self._cancel = args.policy == WatchPolicy.CANCEL
+        self._conf_files: set[str] = set()
+        #  None when watching everything (not ignored) under the task root
+        self._inputs: list[re.Pattern] | None = None
+        self._ignores: list[re.Pattern] = []
+        self._recursive_roots: list[str] = []
+        self._worker: threading.Thread | None = None
+        self._cancelling = False
+        self._rc = 0
+        self._done_r, self._done_w = os.pipe()
+
+    @staticmethod
+    def _abs_patterns(cwd: str, patterns: list[str]) -> list[str]:
+        return [os.path.normpath(os.path.join(cwd, p)) for p in patterns]
+
+    def _setup(self) -> None:
+        """(Re)compute what to watch from the current configuration."""
+        self._conf_files = {os.path.abspath(stamp[0]) for stamp in self.config.deps.files}
+        for path in self._conf_files:
+            self._inotify.watch(os.path.dirname(path))
+
+        tasks, _ = root_tasks(self.config)
+        inputs = []
+        ignores = self._abs_patterns(os.path.abspath(self.config.task_root),
+                                     _DFLT_IGNORES + self.config.args.ignore)
+        for node in TaskGraph(self.config, tasks).nodes.values():
+            task = node.task
+            cwd = os.path.abspath(task.cwd) if task.cwd else os.getcwd()
+            inputs += self._abs_patterns(cwd, task.inputs)
+            ignores += self._abs_patterns(cwd, task.outputs)
+        self._ignores = [_glob_re(p) for p in ignores]
+
+        if inputs:
+            self._inputs = [_glob_re(p) for p in inputs]
+            roots = [_glob_base(p) for p in inputs]
+        else:
+            self._inputs = None
+            roots = [(os.path.abspath(self.config.task_root), True)]
+        self._recursive_roots = [root for root, recursive in roots if recursive]
+        for root, recursive in roots:
+            if recursive:
+                self._watch_tree(root)
+            elif not self._ignored(root, True):
+                self._inotify.watch(root)
+        info("Watching {}", ", ".join(f"'{root}'" for root, _ in roots))
+
+    def _ignored(self, path: str, is_dir: bool = False) -> bool:
+        #  A directory is ignored if everything in it is
+        probe = os.path.join(path, "x") if is_dir else path
+        return any(r.fullmatch(path) or (is_dir and r.fullmatch(probe)) for r in self._ignores)
+
+    def _watch_tree(self, root: str) -> None:
+        for dir_path, dir_names, _ in os.walk(root):
+            if self._ignored(dir_path, True):
+                dir_names[:] = []
+                continue
+            self._inotify.watch(dir_path)
+            dir_names[:] = [d for d in dir_names
+                            if not self._ignored(os.path.join(dir_path, d), True)]
+
+    def _under_recursive_root(self, path: str) -> bool:
+        return any(path.startswith(root.rstrip("/") + "/") for root in self._recursive_roots)
+
+    def _relevant(self, path: str, is_dir: bool) -> bool:
+        if self._ignored(path, is_dir):
+            return False
+        return self._inputs is None or any(r.fullmatch(path) for r in self._inputs)
+
+    def _read_changes(self) -> tuple[str | None, bool]:
+        """Returns a changed path the tasks depend on (if any), and if the configuration
+        changed."""
+        events = self._inotify.read_events()
+        if events is None:
+            info("inotify events were lost")
+            return self.config.task_root, True
+        changed = None
+        conf_changed = False
+        for path, new_dir in events:
+            if path in self._conf_files:
+                conf_changed = True
+                changed = changed or path
+                continue
+            if new_dir and self._under_recursive_root(path) and not self._ignored(path, True):
+                self._watch_tree(path)
+            if changed is None and self._relevant(path, new_dir):
+                changed = path
+        return changed, conf_changed
+
+    def _reload(self) -> bool:
+        old_config = self.config
+        try:
+            self.config = Config(old_config.args)
+            self._setup()
+        except TaskException as e:
+            error_and_print(str(e))
+            self.config = old_config
+            return False
+        print("Configuration reloaded")
+        return True
+
+    def _start_run(self) -> None:
+        reset_cancel()
+        self._cancelling = False
+
+        def _run() -> None:
+            rc = 255
+            try:
+                rc = run_task(self.config)
+            except TaskException as e:
+                error_and_print(str(e))
+            finally:
+                self._rc = rc
+                os.write(self._done_w, b"x")
+
+        self._worker = threading.Thread(target=_run, name="watch-run", daemon=True)
+        self._worker.start()
+
+    def _join_run(self) -> None:
+        assert self._worker
+        self._worker.join()
+        self._worker = None
+        os.read(self._done_r, 64)
+        print(f"Finished with return code {self._rc}, waiting for changes")
+        sys.stdout.flush()
+
+    def _stop(self) -> None:
+        if self._worker is None:
+            return
+        cancel_commands(_CANCEL_GRACE_SECS)
+        self._worker.join()
+        self._worker = None
+
+    def watch(self) -> int:
+        self._setup()
+        sel = selectors.DefaultSelector()
+        sel.register(self._inotify.fd, selectors.EVENT_READ)
+        sel.register(self._done_r, selectors.EVENT_READ)
+        changed_at: float | None = None  # Time of the last change not run for yet
+        reload = False
+        self._start_run()
+        try:
+            while True:
+                timeout = None
+                if changed_at is not None and (self._worker is None or
+                                               (self._cancel and not self._cancelling)):
+                    timeout = max(changed_at + self._debounce - time.monotonic(), 0)
+                for key, _ in sel.select(timeout):
+                    if key.fd == self._done_r:
+                        self._join_run()
+                        continue
+                    path, conf_changed = self._read_changes()
+                    if path is None:
+                        continue
+                    verbose("Change of '{}'", path)
+                    if changed_at is None:
+                        print(f"Change detected in '{path}'")
+                        sys.stdout.flush()
+                    changed_at = time.monotonic()
+                    reload = reload or conf_changed
+                if changed_at is None or time.monotonic() < changed_at + self._debounce:
+                    continue
+                if self._worker is not None:
+                    if self._cancel and not self._cancelling:
+                        print("Cancelling the running tasks")
+                        sys.stdout.flush()
+                        cancel_commands(_CANCEL_GRACE_SECS)
+                        self._cancelling = True
+                    continue
+                changed_at = None
+                if reload:
+                    reload = False
+                    if not self._reload():
+                        continue
+                self._start_run()
+        except KeyboardInterrupt:
+            self._stop()
+            print("Stopped watching")
+            return 0
+        finally:
+            sel.close()
+            os.close(self._done_r)
+            os.close(self._done_w)
+
+
+def watch_tasks(config: Config) -> int:
+    inotify = Inotify.create()
+    if inotify is None:
+        raise TaskException("Watching files requires inotify")
+    try:
+        #  Stopping with SIGTERM stops the running commands too, like Ctrl-C
+        with terminate_as_interrupt():
+            return _Watcher(config, inotify).watch()
+    finally:
+        os.close(inotify.fd)
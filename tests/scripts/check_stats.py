@@ -0,0 +1,12 @@
+#!/usr/bin/env python3
+#  Prints the distinct commands of a '--stats' file, with their return codes and fields
+import json
+import sys
+
+with open(sys.argv[1], "r") as f:
+    records = json.load(f)["commands"]
+lines = set()
+for r in records:
+    fields = ",".join(k for k in sorted(r) if r[k] is not None)
+    lines.add(f"{r['task']}: {r['command']} rc={r['rc']} source={r['source']} fields={fields}")
+print("\n".join(sorted(lines)))
@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+#  Prints the structure of a '--trace' file: the task and command spans, with their arguments
+import json
+import sys
+
+with open(sys.argv[1], "r") as f:
+    trace = json.load(f)
+events = trace["traceEvents"]
+print(f"traceEvents: {type(events).__name__}")
+spans = [e for e in events if e["ph"] == "X"]
+for e in spans:
+    assert e["dur"] >= 0 and isinstance(e["pid"], int) and isinstance(e["tid"], int), e
+tasks = [e for e in spans if e["name"] == "task"]
+for task in tasks:
+    print(f"task: task={task['args']['task']} rc={task['args']['rc']}")
+    end = task["ts"] + task["dur"]
+    for e in spans:
+        if e["name"] != "command" or not task["ts"] <= e["ts"] <= end:
+            continue
+        args = e["args"]
+        print(f"  command: cmd={args['cmd']} rc={args['rc']} "
+              f"pid={type(args['pid']).__name__}")
@@ -0,0 +1,33 @@
+#!/bin/bash
+#  A container tool for testing container pools: logs its invocations to ${FAKE_ENGINE_DIR}/log,
+#  keeps a file per running container and runs executed commands locally
+dir=${FAKE_ENGINE_DIR:?}
+action=$1
+shift
+case ${action} in
+	run)
+		while [[ $# -gt 0 && $1 != "--name" ]]; do shift; done
+		echo "run $2" >> ${dir}/log
+		touch ${dir}/$2
+		echo "$2"
+		;;
+	inspect)
+		#  inspect -f FORMAT NAME
+		[[ -f ${dir}/$3 ]] || exit 1
+		echo true
+		;;
+	rm)
+		#  rm -f NAME
+		echo "rm $2" >> ${dir}/log
+		rm -f ${dir}/$2
+		;;
+	exec)
+		echo "exec $1" >> ${dir}/log
+		shift
+		exec "$@"
+		;;
+	*)
+		echo "fake engine: unsupported action '${action}'" >&2
+		exit 1
+		;;
+esac
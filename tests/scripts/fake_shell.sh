@@ -0,0 +1,3 @@
+#!/bin/sh
+#  Used as a shell_path, to show how it was run
+echo "fake shell: $*"
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+#  Usage: signal_task.py SIGNAL PIDS_FILE COUNT CMD...
+#  Runs CMD in a session of its own, and once COUNT commands wrote their PIDs to PIDS_FILE, sends
+#  SIGNAL to CMD's process group, like a terminal or a service manager would. Shows if CMD
+#  stopped in time, and if the commands it started were left running.
+import os
+import signal
+import subprocess
+import sys
+import time
+
+sig = signal.Signals[sys.argv[1]]
+pids_file = sys.argv[2]
+count = int(sys.argv[3])
+
+
+def _pids() -> list[int]:
+    try:
+        with open(pids_file, "r") as f:
+            return [int(line) for line in f.read().split()]
+    except FileNotFoundError:
+        return []
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+
+
+#  Background jobs of non interactive shells ignore SIGINT, and python keeps ignoring it
+p = subprocess.Popen(sys.argv[4:], start_new_session=True,
+                     preexec_fn=lambda: signal.signal(signal.SIGINT, signal.SIG_DFL))
+deadline = time.monotonic() + 10
+while len(_pids()) < count and time.monotonic() < deadline:
+    time.sleep(0.1)
+start = time.monotonic()
+os.killpg(p.pid, sig)
+try:
+    rc = p.wait(10)
+except subprocess.TimeoutExpired:
+    os.killpg(p.pid, signal.SIGKILL)
+    rc = p.wait()
+stopped = time.monotonic() - start < 5
+time.sleep(0.5)
+left = [pid for pid in _pids() if _alive(pid)]
+for pid in left:
+    os.kill(pid, signal.SIGKILL)
+print(f"{sig.name}: rc={rc}, stopped in time: {stopped}, commands left running: {len(left)}")